@@ -29,17 +29,19 @@ bl_info = {
 import bpy
 
 from . import wizmo
+from . import handlers
 from . import properties
 from . import ui
 from . import operators
 
 from importlib import reload
 reload(wizmo)
+reload(handlers)
 reload(properties)
 reload(ui)
 reload(operators)
 
-from .wizmo import BonezMo3D, ArmzMo
+from .wizmo import BonezMo3D, ArmzMo, BatchzMo
 from .wizmo import GrouzMo, GrouzMoRoots
 from .ui import BONE_PT_pizmo_properties
 from .ui import ARMATURE_PT_pizmo_properties
@@ -49,9 +51,11 @@ from .ui import ARMATURE_PT_pizmo_properties
 def register():
     properties.register_properties()
     operators.register()
+    handlers.register_handlers()
 
     bpy.utils.register_class(ArmzMo)
     bpy.utils.register_class(BonezMo3D)
+    bpy.utils.register_class(BatchzMo)
     bpy.utils.register_class(GrouzMo)
     bpy.utils.register_class(GrouzMoRoots)
     bpy.utils.register_class(BONE_PT_pizmo_properties)
@@ -67,8 +71,10 @@ def unregister():
     bpy.utils.unregister_class(BONE_PT_pizmo_properties)
     bpy.utils.unregister_class(GrouzMoRoots)
     bpy.utils.unregister_class(GrouzMo)
+    bpy.utils.unregister_class(BatchzMo)
     bpy.utils.unregister_class(BonezMo3D)
     bpy.utils.unregister_class(ArmzMo)
 
+    handlers.unregister_handlers()
     operators.unregister()
     properties.unregister_properties()
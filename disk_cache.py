@@ -0,0 +1,111 @@
+import bpy
+import numpy as np
+
+import os
+from hashlib import sha1
+from struct import pack
+
+
+class TriangleCache:
+    """Triangles selected by vertex group weights, saved in the user data folder to be reused by the next sessions.
+
+    Entries are found from the mesh topology and the selection settings, so that they can be loaded before
+    reading the weights. The digest of the weights they were selected from is saved along, to check them later
+    """
+    _instance = None  # stores singleton instance
+    _directory = None
+    max_entries = 512
+    version = 2
+
+    def __new__(cls):
+        """Singleton implementation: initialize only once, return existing instance at any subsequent attempt"""
+        if cls._instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+
+        return cls._instance
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            TriangleCache._directory = bpy.utils.user_resource('DATAFILES', path='pizmo_cache', create=True)
+
+        return self._directory
+
+    def topology_digest(self, triangles, vertex_count):
+        digest = sha1(pack('<II', self.version, vertex_count))
+        digest.update(np.ascontiguousarray(triangles).tobytes())
+        return digest.digest()
+
+    def weights_digest(self, indptr, groups, weights):
+        digest = sha1()
+        for array in (indptr, groups, weights):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.digest()
+
+    def key(self, topology_digest, group_names, weight_threshold):
+        """Return the file name of a triangle selection, from the mesh topology and the selection settings"""
+        digest = sha1(topology_digest)
+        digest.update('\0'.join(sorted(group_names)).encode())
+        digest.update(pack('<d', weight_threshold))
+        return digest.hexdigest() + '.npz'
+
+    def load(self, key, vertex_count):
+        """Return the triangles saved at key and the digest of their weights, None if there are none
+        or they don't fit the mesh anymore
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with np.load(path) as entry:
+                triangles = entry['triangles']
+                weights_digest = entry['weights_digest'].tobytes()
+        except (OSError, ValueError, KeyError):
+            self.discard(key)
+            return None
+
+        if triangles.ndim != 2 or triangles.shape[1] != 3 or (len(triangles) and triangles.max() >= vertex_count):
+            self.discard(key)
+            return None
+
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except OSError:
+            pass
+
+        return triangles, weights_digest
+
+    def save(self, key, triangles, weights_digest):
+        path = os.path.join(self.directory, key)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                np.savez(temp_file, triangles=triangles, weights_digest=np.frombuffer(weights_digest, 'u1'))
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        self.evict()
+
+    def discard(self, key):
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries in excess of max_entries"""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npz')]
+        except OSError:
+            return
+
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,245 @@
+import gpu
+from gpu.types import GPUBatch, GPUIndexBuf, GPUVertBuf, GPUVertFormat
+
+import numpy as np
+
+
+def uniform_color_shader(dims):
+    try:
+        return gpu.shader.from_builtin('3D_UNIFORM_COLOR' if dims == 3 else '2D_UNIFORM_COLOR')
+    except ValueError:
+        # renamed in blender 4.0
+        return gpu.shader.from_builtin('UNIFORM_COLOR')
+
+
+def smooth_color_shader():
+    try:
+        return gpu.shader.from_builtin('3D_SMOOTH_COLOR')
+    except ValueError:
+        # renamed in blender 4.0
+        return gpu.shader.from_builtin('SMOOTH_COLOR')
+
+
+def new_vertex_buffer(vertices):
+    fmt = GPUVertFormat()
+    fmt.attr_add(id="pos", comp_type='F32', len=vertices.shape[1], fetch_mode='FLOAT')
+
+    vbo = GPUVertBuf(len=len(vertices), format=fmt)
+    vbo.attr_fill(id="pos", data=vertices)
+    return vbo
+
+
+def new_indexed_shape(vertices, triangles):
+    """Return a custom shape like Gizmo.new_custom_shape, from unique vertices and their triangle indices"""
+    ibo = GPUIndexBuf(type='TRIS', seq=triangles)
+    return indexed_shape(new_vertex_buffer(vertices), ibo, vertices.shape[1])
+
+
+def indexed_shape(vbo, ibo, dims=3):
+    """Return a custom shape drawing the triangles of an index buffer from a vertex buffer"""
+    shader = uniform_color_shader(dims)
+    batch = GPUBatch(type='TRIS', buf=vbo, elem=ibo)
+    batch.program_set(shader)
+    return batch, shader
+
+
+class SharedShape:
+    """Geometry of a mesh widget and its custom shape, shared by the gizmos of all the viewports"""
+    __slots__ = (
+        "meshshape",
+        "custom_shape",
+        "revision",
+        "users",
+        "_vbo",
+        "_topology",
+        "_generation",
+        "_ibos",
+        "_lods",
+    )
+
+    def __init__(self, meshshape):
+        self.meshshape = meshshape
+        self.custom_shape = None
+        self.revision = 0
+        self.users = 0
+        self._vbo = None
+        self._topology = None
+        self._generation = None
+        self._ibos = {}  # level of detail -> index buffer, kept while the triangles don't change
+        self._lods = {}  # level of detail -> custom shape, all drawing from the same vertex buffer
+
+    def update(self, level=0):
+        """Upload the shape again if the widget vertices have changed, whichever viewport gets here first.
+
+        Return the custom shape at the given level of detail, viewports at different distances can ask for different
+        levels. Decimated levels index the same vertices, only their triangles are uploaded on first request
+        """
+        meshshape = self.meshshape
+        meshshape.update()
+
+        if self.custom_shape is None or self._topology != meshshape.topology:
+            self._vbo = new_vertex_buffer(meshshape.vertices)
+            ibo = GPUIndexBuf(type='TRIS', seq=meshshape.triangles)
+            self.custom_shape = indexed_shape(self._vbo, ibo)
+            self._ibos = {0: ibo}
+            self._lods = {0: self.custom_shape}
+            self._topology = meshshape.topology
+            self._generation = meshshape.generation
+            self.revision += 1
+        elif self._generation != meshshape.generation:
+            # same triangles: a new vertex buffer, uploaded buffers can't be filled again, drawn with the index buffers
+            self._vbo = new_vertex_buffer(meshshape.vertices)
+            self._lods = {lod: indexed_shape(self._vbo, ibo) for lod, ibo in self._ibos.items()}
+            self.custom_shape = self._lods[0]
+            self._generation = meshshape.generation
+            self.revision += 1
+
+        try:
+            return self._lods[level]
+        except KeyError:
+            ibo = GPUIndexBuf(type='TRIS', seq=meshshape.lod_triangles(level))
+            custom_shape = indexed_shape(self._vbo, ibo)
+            self._ibos[level] = ibo
+            self._lods[level] = custom_shape
+            return custom_shape
+
+
+class GeometryStore:
+    """Mesh widget geometry of the session, so that additional viewports don't compute it again"""
+    _instance = None  # stores singleton instance
+    _shapes = {}
+    _primitives = {}  # shape config -> custom shape
+
+    def __new__(cls):
+        """Singleton implementation: initialize only once, return existing instance at any subsequent attempt"""
+        if cls._instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+
+        return cls._instance
+
+    def acquire(self, key, factory):
+        """Return the shared shape stored at key, call factory to create its MeshShape3D if there is none"""
+        try:
+            shared = self._shapes[key]
+        except KeyError:
+            shared = SharedShape(factory())
+            self._shapes[key] = shared
+
+        shared.users += 1
+        return shared
+
+    def release(self, key):
+        try:
+            shared = self._shapes[key]
+        except KeyError:
+            return
+
+        shared.users -= 1
+        if shared.users < 1:
+            del self._shapes[key]
+
+    def primitive(self, key, factory):
+        """Return the custom shape of a primitive widget, each gizmo draws it with its own matrix and color.
+
+        factory returns the unique vertices and the triangle indices of the primitive
+        """
+        try:
+            return self._primitives[key]
+        except KeyError:
+            pass
+
+        custom_shape = new_indexed_shape(*factory())
+        self._primitives[key] = custom_shape
+        return custom_shape
+
+    def clear(self):
+        self._shapes.clear()
+        self._primitives.clear()
+
+
+class MergedBatch:
+    """Mesh widgets of an armature packed in one vertex buffer, with their colors, drawn with a single call"""
+
+    def __init__(self):
+        self.shader = smooth_color_shader()
+        self.batch = None
+        self._shapes = []  # shared shapes of the packed widgets, held so that they are compared by identity
+        self._geometry = None
+        self._vbo = None
+        self._ibo = None
+        self._colors = None
+        self._part_colors = ()
+        self._ranges = ()
+
+    def update(self, parts):
+        """Rebuild the batch if needed. parts is a sequence of (shared shape, rgba color, level of detail) tuples.
+
+        Color changes, as on highlight, only rewrite the colors of the widgets concerned
+        """
+        geometry = tuple((shared.revision, level) for shared, _, level in parts)
+        if geometry == self._geometry and all(shared is packed for (shared, _, _), packed in zip(parts, self._shapes)):
+            self.recolor([color for _, color, _ in parts])
+            return
+        self._geometry = geometry
+        self._shapes = [shared for shared, _, _ in parts]
+
+        if not parts:
+            self.batch = None
+            self._vbo = None
+            self._ibo = None
+            self._part_colors = ()
+            self._ranges = ()
+            return
+
+        for shared, _, level in parts:
+            shared.update(level)
+
+        positions = np.concatenate([shared.meshshape.vertices for shared, _, _ in parts])
+        counts = [shared.meshshape.vertex_count for shared, _, _ in parts]
+        self._part_colors = [color for _, color, _ in parts]
+        self._colors = np.repeat(np.array(self._part_colors, 'f'), counts, axis=0)
+
+        # offset the triangles of each widget past the vertices of the previous ones
+        starts = np.cumsum([0] + counts[:-1], dtype=np.uint32)
+        self._ranges = [(start, start + count) for start, count in zip(starts.tolist(), counts)]
+        triangles = np.concatenate([shared.meshshape.lod_triangles(level) + start
+                                    for (shared, _, level), start in zip(parts, starts)])
+
+        self._vbo = new_vertex_buffer(positions)
+        self._ibo = GPUIndexBuf(type='TRIS', seq=triangles)
+        self.set_batch()
+
+    def set_batch(self):
+        """Draw the packed positions and triangles with the current colors, in a buffer of their own"""
+        fmt = GPUVertFormat()
+        fmt.attr_add(id="color", comp_type='F32', len=4, fetch_mode='FLOAT')
+        colors = GPUVertBuf(len=len(self._colors), format=fmt)
+        colors.attr_fill(id="color", data=self._colors)
+
+        self.batch = GPUBatch(type='TRIS', buf=self._vbo, elem=self._ibo)
+        self.batch.vertbuf_add(colors)
+        self.batch.program_set(self.shader)
+
+    def recolor(self, colors):
+        """Write the colors of the widgets that have changed, positions and triangles are left as they are"""
+        changed = False
+        for i, color in enumerate(colors):
+            if color != self._part_colors[i]:
+                self._part_colors[i] = color
+                start, end = self._ranges[i]
+                self._colors[start:end] = color
+                changed = True
+
+        if changed:
+            # uploaded buffers can't be filled again, only the colors are uploaded to a new one
+            self.set_batch()
+
+    def draw(self):
+        if not self.batch:
+            return
+
+        gpu.state.blend_set('ALPHA')
+        self.shader.bind()
+        self.batch.draw(self.shader)
+        gpu.state.blend_set('NONE')
@@ -0,0 +1,55 @@
+import bpy
+from bpy.app.handlers import persistent
+
+from .mesh_cache import MeshCache, id_key
+from .geometry import GeometryStore
+from .shapes import MeshShape2D
+from .registry import ArmatureRegistry
+
+
+@persistent
+def on_depsgraph_update(scene, depsgraph=None):
+    if depsgraph is None:
+        # blender < 2.91 does not pass the depsgraph to the handler
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    cache = MeshCache()
+    for update in depsgraph.updates:
+        if update.is_updated_geometry or update.is_updated_transform:
+            cache.tag(id_key(update.id))
+
+    ArmatureRegistry().update(depsgraph)
+
+
+@persistent
+def on_frame_change(scene, depsgraph=None):
+    MeshCache().tag_all()
+    ArmatureRegistry().tag_placements()
+
+
+@persistent
+def on_data_reload(*args):
+    MeshCache().clear()
+    GeometryStore().clear()
+    MeshShape2D.clear_projections()
+    ArmatureRegistry().tag()
+
+
+def register_handlers():
+    bpy.app.handlers.depsgraph_update_post.append(on_depsgraph_update)
+    bpy.app.handlers.frame_change_post.append(on_frame_change)
+    bpy.app.handlers.undo_post.append(on_data_reload)
+    bpy.app.handlers.redo_post.append(on_data_reload)
+    bpy.app.handlers.load_post.append(on_data_reload)
+
+
+def unregister_handlers():
+    bpy.app.handlers.load_post.remove(on_data_reload)
+    bpy.app.handlers.redo_post.remove(on_data_reload)
+    bpy.app.handlers.undo_post.remove(on_data_reload)
+    bpy.app.handlers.frame_change_post.remove(on_frame_change)
+    bpy.app.handlers.depsgraph_update_post.remove(on_depsgraph_update)
+
+    MeshCache().clear()
+    GeometryStore().clear()
+    MeshShape2D.clear_projections()
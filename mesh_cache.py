@@ -0,0 +1,293 @@
+import bpy
+import numpy as np
+
+from itertools import count
+from zlib import crc32
+
+from .disk_cache import TriangleCache
+
+
+# shared by all entries, so that a recreated entry never reuses the revision of a discarded one
+_revisions = count(1)
+
+
+def id_key(id_block):
+    """Identity of a datablock that does not change when the datablock is renamed"""
+    original = id_block.original
+    try:
+        return original.session_uid
+    except AttributeError:
+        return original.as_pointer()
+
+
+class EvaluatedMesh:
+    __slots__ = (
+        "coords",
+        "valid",
+        "revision",
+        "_local",
+        "_checksum",
+    )
+
+    def __init__(self):
+        self.coords = np.empty((0, 3), 'f')
+        self.valid = False
+        self.revision = 0
+        self._local = np.empty((0, 3), 'f')
+        self._checksum = None
+
+    def update(self, obj):
+        """Read the evaluated vertices of obj in world space, reusing the buffers of the previous evaluation"""
+        dg = bpy.context.evaluated_depsgraph_get()
+        ob = obj.evaluated_get(dg)
+        mesh = ob.to_mesh()
+        try:
+            count = len(mesh.vertices)
+            if self._local.shape[0] != count:
+                self._local = np.empty((count, 3), 'f')
+                self.coords = np.empty((count, 3), 'f')
+
+            mesh.vertices.foreach_get("co", np.reshape(self._local, count * 3))
+            matrix = np.array(ob.matrix_world, 'f')
+        finally:
+            ob.to_mesh_clear()
+
+        np.matmul(self._local, matrix[:3, :3].T, out=self.coords)
+        self.coords += matrix[:3, 3]
+        self.valid = True
+
+        # depsgraph updates are coarse: only bump the revision if the coordinates have actually changed
+        checksum = crc32(self.coords)
+        if checksum != self._checksum:
+            self._checksum = checksum
+            self.revision = next(_revisions)
+
+
+class MeshWeights:
+    """Loop triangles and vertex group weights of an original mesh.
+
+    Weights are stored as a sparse vertex x group table in CSR layout: the groups and weights
+    of vertex i are found at groups[indptr[i]:indptr[i + 1]] and weights[indptr[i]:indptr[i + 1]]
+    """
+    __slots__ = (
+        "triangles",
+        "indptr",
+        "groups",
+        "weights",
+        "vertex_count",
+        "valid",
+        "_triangle_weights",
+        "_topology_digest",
+        "_weights_digest",
+    )
+
+    def __init__(self):
+        self.triangles = np.empty((0, 3), 'i')
+        self.indptr = None
+        self.groups = None
+        self.weights = None
+        self.vertex_count = 0
+        self.valid = False
+        self._triangle_weights = {}
+        self._topology_digest = None
+        self._weights_digest = None
+
+    def update(self, mesh):
+        mesh.calc_loop_triangles()
+        self.vertex_count = len(mesh.vertices)
+
+        count = len(mesh.loop_triangles)
+        self.triangles = np.empty((count, 3), 'i')
+        mesh.loop_triangles.foreach_get("vertices", np.reshape(self.triangles, count * 3))
+
+        # weights are read on demand, meshes without vertex group widgets don't need them
+        self.indptr = None
+        self.groups = None
+        self.weights = None
+        self._triangle_weights.clear()
+        self._topology_digest = None
+        self._weights_digest = None
+        self.valid = True
+
+    def read_weights(self, mesh):
+        counts = np.empty(len(mesh.vertices), 'i')
+        groups = []
+        weights = []
+        # vertex group elements have no bulk accessor, this is the only pass over them
+        for i, vert in enumerate(mesh.vertices):
+            vert_groups = vert.groups
+            counts[i] = len(vert_groups)
+            for elem in vert_groups:
+                groups.append(elem.group)
+                weights.append(elem.weight)
+
+        self.indptr = np.zeros(len(counts) + 1, 'i')
+        np.cumsum(counts, out=self.indptr[1:])
+        self.groups = np.array(groups, 'i')
+        self.weights = np.array(weights, 'f')
+        self._triangle_weights.clear()
+        self._weights_digest = None
+
+    def topology_digest(self):
+        """Return the digest of the triangles used by the disk cache, computed once per mesh revision"""
+        if self._topology_digest is None:
+            self._topology_digest = TriangleCache().topology_digest(self.triangles, self.vertex_count)
+        return self._topology_digest
+
+    def weights_digest(self):
+        """Return the digest of the weights saved in the disk cache, computed once per read of the weights"""
+        if self._weights_digest is None:
+            self._weights_digest = TriangleCache().weights_digest(self.indptr, self.groups, self.weights)
+        return self._weights_digest
+
+    def max_weights(self, group_indices):
+        """Return the highest weight of each vertex among the given groups, -inf for vertices not in any of them"""
+        vert_count = len(self.indptr) - 1
+        rows = np.repeat(np.arange(vert_count), np.diff(self.indptr))
+        in_groups = np.isin(self.groups, group_indices)
+
+        result = np.full(vert_count, -np.inf, 'f')
+        np.maximum.at(result, rows[in_groups], self.weights[in_groups])
+        return result
+
+    def triangle_weights(self, group_indices):
+        """Return the lowest vertex weight of each triangle in the given groups, computed once per group set"""
+        key = tuple(sorted(group_indices))
+        try:
+            return self._triangle_weights[key]
+        except KeyError:
+            pass
+
+        vert_weights = self.max_weights(key)
+        tris_weights = np.min(vert_weights[self.triangles], axis=1)
+        self._triangle_weights[key] = tris_weights
+        return tris_weights
+
+    def select_triangles(self, group_indices, weight_threshold):
+        """Return the triangles whose vertices all have a weight above weight_threshold in one of the groups"""
+        tris_weights = self.triangle_weights(group_indices)
+        # compare in double precision, as python does with the weights of vertex group elements
+        return self.triangles[tris_weights.astype(np.float64) > weight_threshold]
+
+
+class MeshCache:
+    """Evaluated world space coordinates of widget meshes, shared by all the gizmos using the same object"""
+    _instance = None  # stores singleton instance
+    _entries = {}
+    _weights = {}
+    _unverified = {}  # disk cache entry -> weights digest of the triangles loaded from it
+    _saved = {}  # disk cache entry -> weights digest of the triangles saved or verified during this session
+
+    def __new__(cls):
+        """Singleton implementation: initialize only once, return existing instance at any subsequent attempt"""
+        if cls._instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+
+        return cls._instance
+
+    def evaluated(self, obj):
+        """Return the evaluated mesh entry of obj, its revision changes whenever its coordinates do"""
+        key = id_key(obj)
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            entry = EvaluatedMesh()
+            self._entries[key] = entry
+
+        if not entry.valid:
+            entry.update(obj)
+
+        return entry
+
+    def mesh_weights(self, mesh, read_weights=True):
+        """Return triangles and vertex group weights of the original mesh"""
+        key = id_key(mesh)
+        try:
+            entry = self._weights[key]
+        except KeyError:
+            entry = MeshWeights()
+            self._weights[key] = entry
+
+        if not entry.valid:
+            entry.update(mesh.original)
+        if read_weights and entry.indptr is None:
+            entry.read_weights(mesh.original)
+
+        return entry
+
+    def disk_key(self, entry, group_names, weight_threshold):
+        return TriangleCache().key(entry.topology_digest(), group_names, weight_threshold)
+
+    def load_triangles(self, mesh, group_names, weight_threshold):
+        """Return the triangles saved by a previous session for this selection, None if there are none.
+
+        They are returned without reading the weights, verify_triangles checks them against the weights later
+        """
+        entry = self.mesh_weights(mesh, read_weights=False)
+        if entry.indptr is not None:
+            # the weights have been read already, selecting is faster than loading
+            return None
+
+        disk_key = self.disk_key(entry, group_names, weight_threshold)
+        loaded = TriangleCache().load(disk_key, entry.vertex_count)
+        if loaded is None:
+            return None
+
+        triangles, weights_digest = loaded
+        self._unverified[disk_key] = weights_digest
+        return triangles
+
+    def verify_triangles(self, mesh, group_names, group_indices, weight_threshold):
+        """Check the triangles of load_triangles against the weights, return the right ones if they differ"""
+        entry = self.mesh_weights(mesh, read_weights=False)
+        disk_key = self.disk_key(entry, group_names, weight_threshold)
+        try:
+            weights_digest = self._unverified[disk_key]
+        except KeyError:
+            # not loaded from the disk cache, or loaded for other settings
+            return None
+
+        entry = self.mesh_weights(mesh)
+        if weights_digest == entry.weights_digest():
+            self._saved[disk_key] = weights_digest
+            return None
+
+        return self.select_triangles(mesh, group_names, group_indices, weight_threshold, save=True)
+
+    def select_triangles(self, mesh, group_names, group_indices, weight_threshold, save=False):
+        """Return the triangles of mesh whose vertices all have a weight above weight_threshold in the groups.
+
+        With save, the selection is written to the disk cache for the next sessions. Threshold edits don't save,
+        so that dragging the threshold doesn't write a file at each step
+        """
+        entry = self.mesh_weights(mesh)
+        triangles = entry.select_triangles(group_indices, weight_threshold)
+        if save:
+            disk_key = self.disk_key(entry, group_names, weight_threshold)
+            weights_digest = entry.weights_digest()
+            if self._saved.get(disk_key) != weights_digest:
+                TriangleCache().save(disk_key, triangles, weights_digest)
+                self._saved[disk_key] = weights_digest
+
+        return triangles
+
+    def tag(self, key):
+        try:
+            self._entries[key].valid = False
+        except KeyError:
+            pass
+        try:
+            self._weights[key].valid = False
+        except KeyError:
+            pass
+
+    def tag_all(self):
+        for entry in self._entries.values():
+            entry.valid = False
+
+    def clear(self):
+        self._entries.clear()
+        self._weights.clear()
+        self._unverified.clear()
+        self._saved.clear()
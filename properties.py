@@ -78,7 +78,7 @@ def register_bone_properties():
     bpy.types.PoseBone.pizmo_min_vertweight = FloatProperty(name="Display Group Threshold",
                                                             description="Minimum weight for displayed vertices",
                                                             min=0.0, max=1.0, default=0.2,
-                                                            update=wizmo.GrouzMo.mark_dirty)
+                                                            update=wizmo.GrouzMo.mark_threshold_dirty)
 
 
 def register_armature_properties():
@@ -120,18 +120,34 @@ def register_armature_properties():
                                                      update=wizmo.GrouzMo.mark_dirty
                                                      )
 
+    armature_type.pizmo_skin_widgets = BoolProperty(name="Skin Mesh Widgets",
+                                                    description="Deform mesh widgets with the bones weights, "
+                                                                "rather than evaluating the whole mesh",
+                                                    default=False,
+                                                    update=wizmo.GrouzMo.mark_dirty)
+
+    armature_type.pizmo_merged_draw = BoolProperty(name="Merge Widgets Drawing",
+                                                   description="Draw all the mesh widgets in a single call",
+                                                   default=False)
+
 
 def register_properties():
     bpy.types.WindowManager.pizmo_display_widgets = bpy.props.BoolProperty(name="Display Pizmo",
                                                                            description="Geometry picker for armatures",
                                                                            default=True)
 
+    bpy.types.WindowManager.pizmo_triangle_budget = bpy.props.IntProperty(name="Triangle Budget",
+                                                                          description="Mesh widgets triangles drawn in "
+                                                                                      "each viewport, 0 for no limit",
+                                                                          min=0, default=0)
+
     register_bone_properties()
     register_armature_properties()
 
 
 def unregister_properties():
     del bpy.types.WindowManager.pizmo_display_widgets
+    del bpy.types.WindowManager.pizmo_triangle_budget
 
     del bpy.types.PoseBone.pizmo_vis_type
     del bpy.types.PoseBone.pizmo_vis_shape
@@ -151,4 +167,6 @@ def unregister_properties():
     del bpy.types.Armature.pizmo_color_alpha
     del bpy.types.Armature.pizmo_color_selected
     del bpy.types.Armature.pizmo_widget_scale
+    del bpy.types.Armature.pizmo_merged_draw
+    del bpy.types.Armature.pizmo_skin_widgets
     del bpy.types.Armature.pizmo_armature_root
@@ -0,0 +1,198 @@
+import bpy
+import numpy as np
+
+from .mesh_cache import id_key
+
+
+class RootPlacement:
+    """World space location of the root widget of an armature, with the frame it has been computed at"""
+    __slots__ = (
+        "location",
+        "visible",
+        "frame",
+        "valid",
+        "revision",
+    )
+
+    def __init__(self):
+        self.location = None
+        self.visible = False
+        self.frame = None
+        self.valid = False
+        self.revision = 0
+
+    @staticmethod
+    def local_location(obj):
+        """Return the root location in the armature space: the root bone head, or the bottom center of the bounds"""
+        root_name = obj.data.pizmo_armature_root
+        if root_name:
+            try:
+                return tuple(obj.pose.bones[root_name].matrix.translation)
+            except KeyError:
+                return None
+
+        bound = obj.bound_box
+        return (bound[0][0] + bound[7][0]) / 2, (bound[0][1] + bound[7][1]) / 2, bound[0][2]  # bbox min Z
+
+    def read(self, obj, frame):
+        """Read visibility and root location of obj, return the local location and the world matrix to apply"""
+        self.frame = frame
+        self.valid = True
+        self.visible = obj.visible_get()
+        return self.local_location(obj), obj.matrix_world
+
+    def set_location(self, location):
+        if location != self.location:
+            self.location = location
+            self.revision += 1
+
+
+class ArmatureRegistry:
+    """Armature objects that display a root widget, tracked by a key that survives renames"""
+    _instance = None  # stores singleton instance
+    _names = {}  # object key -> object name
+    _placements = {}  # object key -> root widget placement
+    _valid = False
+    revision = 0
+
+    def __new__(cls):
+        """Singleton implementation: initialize only once, return existing instance at any subsequent attempt"""
+        if cls._instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+
+        return cls._instance
+
+    @staticmethod
+    def uses_widget(obj):
+        return obj.type == 'ARMATURE' and obj.data.pizmo_armature_widget
+
+    def keys(self):
+        if not self._valid:
+            self.rebuild()
+
+        return list(self._names.keys())
+
+    def get_object(self, key):
+        if not self._valid:
+            self.rebuild()
+
+        try:
+            obj = bpy.data.objects[self._names[key]]
+        except KeyError:
+            obj = None
+
+        if obj is None or id_key(obj) != key:
+            # renamed, the only case that requires looking through the objects again
+            obj = next((ob for ob in bpy.data.objects if ob.type == 'ARMATURE' and id_key(ob) == key), None)
+            if obj is None:
+                self.remove(key)
+                return None
+            self._names[key] = obj.name
+
+        return obj
+
+    def add(self, obj):
+        key = id_key(obj)
+        if self._names.get(key) != obj.name:
+            self._names[key] = obj.name
+            self._bump()
+
+    def remove(self, key):
+        self._placements.pop(key, None)
+        if self._names.pop(key, None) is not None:
+            self._bump()
+
+    def placements(self, keys, frame):
+        """Return the root widget placements of the armatures by key, the outdated ones are updated together"""
+        result = {}
+        stale = []
+        for key in keys:
+            placement = self._placements.get(key)
+            if placement is None:
+                placement = RootPlacement()
+                self._placements[key] = placement
+            result[key] = placement
+            if not placement.valid or placement.frame != frame:
+                stale.append(key)
+
+        if not stale:
+            return result
+
+        updated = []
+        locals_ = []
+        matrices = []
+        for key in stale:
+            obj = self.get_object(key)
+            if obj is None:
+                result[key] = None
+                continue
+            placement = result[key]
+            local, matrix_world = placement.read(obj, frame)
+            if local is None:
+                placement.set_location(None)
+                continue
+            updated.append(placement)
+            locals_.append(local)
+            matrices.append(matrix_world)
+
+        if updated:
+            # bring all the root locations to world space at once
+            matrices = np.array(matrices, 'd')
+            locations = np.einsum('nij,nj->ni', matrices[:, :3, :3], np.array(locals_, 'd')) + matrices[:, :3, 3]
+            for placement, location in zip(updated, locations.tolist()):
+                placement.set_location(tuple(location))
+
+        return result
+
+    def tag_placement(self, key):
+        try:
+            self._placements[key].valid = False
+        except KeyError:
+            pass
+
+    def tag_placements(self):
+        for placement in self._placements.values():
+            placement.valid = False
+
+    def update(self, depsgraph):
+        """Follow the armatures added, changed or removed in a depsgraph update"""
+        if not self._valid:
+            return
+
+        check_removed = False
+        for update in depsgraph.updates:
+            id_block = update.id.original
+            if isinstance(id_block, bpy.types.Object):
+                if self.uses_widget(id_block):
+                    self.add(id_block)
+                    self.tag_placement(id_key(id_block))
+                else:
+                    self.remove(id_key(id_block))
+            elif isinstance(id_block, (bpy.types.Collection, bpy.types.Scene)):
+                # objects have been linked or unlinked, or their visibility has changed
+                check_removed = True
+
+        if check_removed:
+            self.tag_placements()
+            for key, name in list(self._names.items()):
+                obj = bpy.data.objects.get(name)
+                if obj is None or id_key(obj) != key:
+                    self.get_object(key)
+
+    def rebuild(self):
+        self._names.clear()
+        self._placements.clear()
+        for obj in bpy.data.objects:
+            if self.uses_widget(obj):
+                self._names[id_key(obj)] = obj.name
+
+        self._valid = True
+        self._bump()
+
+    def tag(self):
+        self._valid = False
+
+    @classmethod
+    def _bump(cls):
+        cls.revision += 1
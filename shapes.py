@@ -1,35 +1,62 @@
 import bpy
 
 from math import pi
-from math import cos
-from math import sin
-from math import sqrt
 
-from copy import deepcopy
+from functools import lru_cache
+from zlib import crc32
 import numpy as np
 
 from .enum_types import Axis
+from .mesh_cache import MeshCache, id_key
+from .skinning import Skin
+
+
+def _vertices(coords):
+    """Read-only float32 array of vertex coordinates, for the vertices shared at class level"""
+    vertices = np.array(coords, 'f')
+    vertices.flags.writeable = False
+    return vertices
+
+
+def _strip(first, second):
+    """Interleave two vertex arrays as first[0], second[0], then first[i], second[i - 1], first[i], second[i]"""
+    count, dim = first.shape
+    verts = np.empty((count, 4, dim), first.dtype)
+    verts[:, 0] = first
+    verts[1:, 1] = second[:-1]
+    verts[:, 2] = first
+    verts[:, 3] = second
+    return verts.reshape(count * 4, dim)[2:]
+
+
+def _fan(segments, scale=1.0):
+    """Triangles of a circle of the given number of segments, around the origin"""
+    arcs = (2 * pi / segments) * np.arange(segments + 1)
+    ring = np.column_stack((np.cos(arcs), np.sin(arcs)))
+    # both ends of every segment lie on the circle of radius scale
+    ring *= scale
+
+    verts = np.zeros((segments, 3, 2))
+    verts[:, 0] = ring[:-1]
+    verts[:, 1] = ring[1:]
+    return verts.reshape(segments * 3, 2)
 
 
 class BasicShape:
-    vertices = []
+    vertices = _vertices(np.empty((0, 2)))
 
     def __init__(self, scale=1.0, offset=(0.0, 0.0)):
         # make vertices unique to instance
-        self.vertices = deepcopy(self.vertices)
+        self.vertices = np.array(self.vertices, 'f')
         self.scale(scale)
         self.offset(offset)
         self.center()
 
     def scale(self, factor):
-        for verts in self.vertices:
-            for i, co in enumerate(verts):
-                verts[i] = co * factor
+        self.vertices *= factor
 
     def offset(self, offset):
-        for verts in self.vertices:
-            for i, co in enumerate(verts):
-                verts[i] = co + offset[i]
+        self.vertices += np.asarray(offset, 'f')
 
     @property
     def size(self):
@@ -40,19 +67,30 @@ class BasicShape:
         size_x, size_y = self.size
         self.offset((size_x/-2.0, size_y/-2.0))
 
+    def frame_vertices(self, thickness=0.25):
+        """Return the triangles of a frame of the given thickness, scaling the vertices toward the center"""
+        inner = self.vertices.copy()
+        inner[:, :2] *= 1 - thickness
+        return _strip(self.vertices, inner)
+
 
 class Tris2D(BasicShape):
-    vertices = [
+    vertices = _vertices([
         [0.0, 0.0],
         [0.0, 1.0],
         [1.0, 1.0],
-    ]
+    ])
 
 
 class Quad2D(BasicShape):
-    vertices = deepcopy(Tris2D.vertices) + [deepcopy(Tris2D.vertices[-1]),
-                                            [Tris2D.vertices[-1][0], Tris2D.vertices[0][1]],
-                                            deepcopy(Tris2D.vertices[0])]
+    vertices = _vertices(np.concatenate((Tris2D.vertices, Tris2D.vertices[[-1]],
+                                         [[Tris2D.vertices[-1][0], Tris2D.vertices[0][1]]],
+                                         Tris2D.vertices[[0]])))
+
+    # outer (0) or inner (1) quad, and vertex, of the frame triangles
+    _frame_sources = np.tile([0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0], 2)
+    _frame_indices = np.array([0, 1, 0, 0, 1, 1, 1, 2, 1, 1, 2, 2,
+                               3, 4, 3, 3, 4, 4, 4, 5, 4, 4, 5, 5])
 
     @property
     def size(self):
@@ -64,30 +102,12 @@ class Quad2D(BasicShape):
         inner = Quad2D(scale=1 - thickness)
         inner.center()
 
-        verts = []
-        for i in range(0, 4, 3):
-            verts.append(self.vertices[i])
-            verts.append(self.vertices[i + 1])
-            verts.append(inner.vertices[i])
-
-            verts.append(inner.vertices[i])
-            verts.append(inner.vertices[i + 1])
-            verts.append(self.vertices[i + 1])
-
-            verts.append(self.vertices[i + 1])
-            verts.append(self.vertices[i + 2])
-            verts.append(inner.vertices[i + 1])
-
-            verts.append(inner.vertices[i + 1])
-            verts.append(inner.vertices[i + 2])
-            verts.append(self.vertices[i + 2])
-
-        return verts
+        return np.stack((self.vertices, inner.vertices))[self._frame_sources, self._frame_indices]
 
 
 class Rect2D(BasicShape):
     # Coordinates (each one is a triangle).
-    vertices = [
+    vertices = _vertices([
         [-0.5, -1.0],
         [-0.5, 1.0],
         [0.5, 1.0],
@@ -95,11 +115,11 @@ class Rect2D(BasicShape):
         [0.5, 1.0],
         [0.5, -1.0],
         [-0.5, -1.0],
-    ]
+    ])
 
 
 class Cross2D(BasicShape):
-    vertices = deepcopy(Rect2D.vertices) + [
+    vertices = _vertices(np.concatenate((Rect2D.vertices, [
         [-1.0, -0.5],
         [-1.0, 0.5],
         [1.0, 0.5],
@@ -107,207 +127,343 @@ class Cross2D(BasicShape):
         [1.0, 0.5],
         [1.0, -0.5],
         [-1.0, -0.5],
-    ]
+    ])))
 
 
 class Circle2D(BasicShape):
     def __init__(self, scale=1.0, offset=(0.0, 0.0), segments=24):
         self.segments = segments
-        self.vertices = []
 
         if any(offset):
             raise NotImplementedError
 
-        full_circle = 2 * pi
-        arc_len = full_circle / self.segments
-
-        for i in range(self.segments):
-            arc = arc_len * i
-            self.vertices.append([cos(arc) * scale, sin(arc * scale)])
-            arc = arc_len * (i + 1)
-            self.vertices.append([cos(arc) * scale, sin(arc) * scale])
-            self.vertices.append([0.0, 0.0])
+        self.vertices = _fan(segments, scale).astype('f')
 
     @property
     def size(self):
-        vert = self.vertices[0]
-        diameter = sqrt(pow(vert[0], 2) + pow(vert[1], 2))
+        diameter = float(np.linalg.norm(self.vertices[0]))
         return diameter, diameter
 
-    def frame_vertices(self, thickness=0.25):
-        scale = 1 - thickness
-        verts = []
-
-        inner = None
-        for vert in self.vertices:
-            if inner:
-                verts.append(vert)
-                verts.append(inner)
-            verts.append(vert)
-            inner = [vert[0] * scale, vert[1] * scale]
-            verts.append(inner)
-
-        return verts
-
 
 class Sphere(BasicShape):
     def __init__(self, scale=1.0, offset=(0.0, 0.0, 0.0), segments=24, rings=12):
         self.segments = segments
-        self.vertices = []
 
-        full_circle = 2 * pi
-        arc_len = full_circle / self.segments
-
-        circle_verts = []
-        for i in range(self.segments):
-            arc = arc_len * i
-            circle_verts.append([cos(arc), sin(arc), 0.0])
-            arc = arc_len * (i + 1)
-            circle_verts.append([cos(arc), sin(arc), 0.0])
-            circle_verts.append([0.0, 0.0, 0.0])
-
-        upper = None
+        circle_verts = _fan(segments)
+        half_rings = int(rings / 2)
 
         # TODO: better way of drawing a sphere
-        prev_height = 0
-        next_height = 0
-        prev_scale = scale
-        for _ in range(int(rings/2)):
-            next_height += 2 / rings
-            next_scale = sqrt(1 - next_height ** 2) * scale
-            for circle_vert in circle_verts:
-                if upper:
-                    self.vertices.append([circle_vert[0] * prev_scale, circle_vert[1] * prev_scale, prev_height * scale])
-                    self.vertices.append(upper)
-
-                self.vertices.append([circle_vert[0] * prev_scale, circle_vert[1] * prev_scale, prev_height * scale])
-                upper = [circle_vert[0] * next_scale, circle_vert[1] * next_scale, next_height * scale]
-                self.vertices.append(upper)
-            prev_height = next_height
-            prev_scale = next_scale
-
-        prev_height = 0
-        next_height = 0
-        prev_scale = scale
-        for _ in range(int(rings / 2)):
-            next_height -= 2 / rings
-            next_scale = sqrt(1 - next_height ** 2) * scale
-            for circle_vert in circle_verts:
-                if upper:
-                    self.vertices.append([circle_vert[0] * prev_scale, circle_vert[1] * prev_scale, prev_height * scale])
-                    self.vertices.append(upper)
-
-                self.vertices.append([circle_vert[0] * prev_scale, circle_vert[1] * prev_scale, prev_height * scale])
-                upper = [circle_vert[0] * next_scale, circle_vert[1] * next_scale, next_height * scale]
-                self.vertices.append(upper)
-            prev_height = next_height
-            prev_scale = next_scale
-
+        lower = []
+        upper = []
+        steps = np.cumsum(np.full(half_rings, 2 / rings))
+        for next_heights in (steps, -steps):
+            next_scales = np.sqrt(1 - next_heights ** 2) * scale
+            prev_heights = np.concatenate(([0.0], next_heights[:-1]))
+            prev_scales = np.concatenate(([scale], next_scales[:-1]))
+
+            for heights, scales, rows in ((prev_heights, prev_scales, lower), (next_heights, next_scales, upper)):
+                ring_verts = np.empty((half_rings, len(circle_verts), 3))
+                ring_verts[:, :, :2] = circle_verts * scales[:, None, None]
+                ring_verts[:, :, 2] = (heights * scale)[:, None]
+                rows.append(ring_verts.reshape(-1, 3))
+
+        # each upper vertex closes a triangle with the next lower one
+        self.vertices = _strip(np.concatenate(lower), np.concatenate(upper)).astype('f')
         self.offset(offset)
 
-    def offset(self, offset):
-        for i, vert in enumerate(self.vertices):
-            self.vertices[i] = deepcopy(vert)
-            for j, offs in enumerate(offset):
-                self.vertices[i][j] += offs
-
     @property
     def size(self):
-        vert = self.vertices[0]
-        diameter = sqrt(pow(vert[0], 2) + pow(vert[1], 2))
+        diameter = float(np.linalg.norm(self.vertices[0][:2]))
         return diameter, diameter
 
-    def frame_vertices(self, thickness=0.25):
-        scale = 1 - thickness
-        verts = []
 
-        inner = None
-        for vert in self.vertices:
-            if inner:
-                verts.append(vert)
-                verts.append(inner)
-            verts.append(vert)
-            inner = [vert[0] * scale, vert[1] * scale]
-            verts.append(inner)
+@lru_cache(maxsize=64)
+def primitive_vertices(shape_class, scale=1.0, offset=None, segments=24, rings=12, frame_thickness=None):
+    """Return the vertices of a primitive shape as a read-only float32 array, generated once per set of arguments"""
+    kwargs = {'scale': scale}
+    if offset is not None:
+        kwargs['offset'] = offset
+    if shape_class in (Circle2D, Sphere):
+        kwargs['segments'] = segments
+    if shape_class is Sphere:
+        kwargs['rings'] = rings
+
+    shape = shape_class(**kwargs)
+    if frame_thickness is None:
+        vertices = shape.vertices
+    else:
+        vertices = shape.frame_vertices(thickness=frame_thickness)
+
+    vertices = np.array(vertices, 'f')
+    vertices.flags.writeable = False
+    return vertices
+
+
+def index_vertices(vertices):
+    """Return the unique vertices of a triangle list and the (n, 3) uint32 triangles indexing them"""
+    vertices = np.asarray(vertices, 'f')
+    # incomplete triangles are not drawn anyway
+    vertices = vertices[:len(vertices) // 3 * 3]
+    if not len(vertices):
+        return vertices, np.empty((0, 3), np.uint32)
 
-        return verts
+    unique, inverse = np.unique(vertices, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1, 3).astype(np.uint32)
+
+
+@lru_cache(maxsize=64)
+def primitive_indexed(shape_class, **kwargs):
+    """Return the unique vertices and triangle indices of a primitive shape, as read-only arrays"""
+    vertices, triangles = index_vertices(primitive_vertices(shape_class, **kwargs))
+    vertices.flags.writeable = False
+    triangles.flags.writeable = False
+    return vertices, triangles
+
+
+# grid cells across the widget at each decimated level of detail, level 0 is the full resolution
+LOD_CELLS = (64, 32, 16)
+
+
+def cluster_triangles(vertices, triangles, cells):
+    """Decimate triangles by vertex clustering: vertices in the same cell of a grid of cells per side are merged.
+
+    Merged vertices are replaced by one of them, so the result indexes the same vertices
+    """
+    if not len(triangles):
+        return triangles
+
+    low = vertices.min(axis=0)
+    size = (vertices.max(axis=0) - low).max() / cells
+    if size <= 0.0:
+        return triangles
+
+    cell_ids = np.floor((vertices - low) / size).astype(np.int64)
+    _, first, inverse = np.unique(cell_ids, axis=0, return_index=True, return_inverse=True)
+    merged = first.astype(np.uint32)[inverse.ravel()][triangles]
+
+    # drop the triangles collapsed to a line or a point, then the duplicates, keeping the winding of the first
+    keep = (merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) & (merged[:, 2] != merged[:, 0])
+    merged = merged[keep]
+    _, unique = np.unique(np.sort(merged, axis=1), axis=0, return_index=True)
+    return merged[np.sort(unique)]
 
 
 class MeshShape3D(BasicShape):
 
-    def __init__(self, mesh, scale=1.0, vertex_groups=None, weight_threshold=0.2):
-        self._indices = []
+    def __init__(self, mesh, scale=1.0, vertex_groups=None, weight_threshold=0.2, armature=None):
+        self._vert_indices = np.empty(0, 'i')  # mesh vertices used by the triangles, each one only once
+        self._vert_counts = np.empty(0, 'i')  # number of triangle corners at each of those vertices
+        self.triangles = np.empty((0, 3), np.uint32)
+        self.topology = 0  # changes whenever the triangles do
+        self.generation = 0  # changes whenever the vertices move
+        self.center = np.zeros(3, 'f')
+        self.radius = 0.0
+        self._lods = {}  # level of detail -> decimated triangles
+        self._buffer = np.empty((0, 3), 'f')
         self._obj = None
+        self._armature = armature  # deforms the widget through skinning, rather than evaluating the mesh
+        self._skin = None
+        self._group_names = []
+        self._group_indices = []
+        self._revision = None
+        self._checksum = None
         self.scale_factor = scale
+        self.weight_threshold = weight_threshold
         self.tris_from_mesh(mesh, vertex_groups=vertex_groups, weight_threshold=weight_threshold)
 
+    @property
+    def vertex_count(self):
+        return len(self._vert_indices)
+
+    @property
+    def triangle_count(self):
+        return len(self.triangles)
+
     @property
     def vertices(self):
+        """Unique vertices of the widget, in world space, indexed by triangles"""
         if not self._obj:
-            return []
-
-        dg = bpy.context.evaluated_depsgraph_get()
-        ob = self._obj.evaluated_get(dg)
-        mesh = ob.to_mesh()
-        mesh.calc_loop_triangles()
+            return self._buffer
+
+        self.update()
+        return self._buffer
+
+    def update(self):
+        """Gather the vertices again if the evaluated mesh has changed, return True if they have actually moved"""
+        if self._buffer.shape[0] != len(self._vert_indices):
+            self._buffer = np.empty((len(self._vert_indices), 3), 'f')
+        verts = self._buffer
+        if not len(verts):
+            # no triangle above the weight threshold
+            return False
+
+        if self._armature:
+            if self._skin is None:
+                self._skin = Skin(self._obj, self._armature, self._vert_indices)
+            if not self._skin.deform(self._obj, self._armature, verts):
+                return False
+        else:
+            entry = MeshCache().evaluated(self._obj)
+            if entry.revision == self._revision:
+                return False
+            self._revision = entry.revision
 
-        verts = np.array([ob.matrix_world @ mesh.vertices[i].co for i in self._indices], 'f')
+            np.take(entry.coords, self._vert_indices, axis=0, out=verts)
 
-        # scale
-        average = np.average(verts, axis=0)
+        # scale around the average of the triangle corners
+        average = np.average(verts, axis=0, weights=self._vert_counts).astype('f')
         verts -= average
         verts *= self.scale_factor
+        if len(verts):
+            self.radius = float(np.sqrt(np.max(np.einsum('ij,ij->i', verts, verts))))
         verts += average
-
-        return verts
+        self.center = average
+
+        # the mesh may have changed elsewhere, away from the triangles of this shape
+        checksum = crc32(verts)
+        if checksum == self._checksum:
+            return False
+        self._checksum = checksum
+        self.generation += 1
+        return True
+
+    def lod_triangles(self, level):
+        """Return the triangles at the given level of detail, they index the same vertices as the full resolution"""
+        if level < 1:
+            return self.triangles
+
+        try:
+            return self._lods[level]
+        except KeyError:
+            pass
+
+        # decimate the coarser levels from the finer ones, it is faster and keeps them consistent
+        finer = self.lod_triangles(level - 1)
+        triangles = cluster_triangles(self.vertices, finer, LOD_CELLS[level - 1])
+        self._lods[level] = triangles
+        return triangles
+
+    def invalidate(self):
+        self._revision = None
+        self._checksum = None
+        self._skin = None
+
+    def set_triangles(self, triangles):
+        """Set the mesh triangles to display, given as (n, 3) vertex indices of the mesh"""
+        self._vert_indices, inverse, self._vert_counts = np.unique(triangles, return_inverse=True,
+                                                                   return_counts=True)
+        self.triangles = inverse.reshape(-1, 3).astype(np.uint32)
+        self._lods.clear()
+        self.topology += 1
+        self.invalidate()
 
     def tris_from_mesh(self, obj, vertex_groups=[], weight_threshold=0.2):
         self._obj = obj
+        self.weight_threshold = weight_threshold
 
-        mesh = self._obj.data
-        mesh.calc_loop_triangles()
-
-        self._indices = []
         if vertex_groups:
-            group_idx = [obj.vertex_groups[vertex_group].index for vertex_group in vertex_groups]
-
-            for tris in mesh.loop_triangles:
-                if all(any(g.weight > weight_threshold for g in mesh.vertices[i].groups if g.group in group_idx) for i in tris.vertices):
-                    self._indices.extend(tris.vertices)
+            self._group_names = list(vertex_groups)
+            self._group_indices = [obj.vertex_groups[vertex_group].index for vertex_group in vertex_groups]
+            cache = MeshCache()
+            triangles = cache.load_triangles(self._obj.data, self._group_names, weight_threshold)
+            if triangles is None:
+                triangles = cache.select_triangles(self._obj.data, self._group_names, self._group_indices,
+                                                   weight_threshold, save=True)
+            else:
+                # displayed right away, checked against the weights once the interface is idle
+                bpy.app.timers.register(self.verify_triangles, first_interval=0.5)
+            self.set_triangles(triangles)
         else:
-            indices = np.empty((len(mesh.loop_triangles), 3), 'i')
-            mesh.loop_triangles.foreach_get(
-                "vertices", np.reshape(indices, len(mesh.loop_triangles) * 3))
-
-            self._indices = np.concatenate(indices)
+            self._group_names = []
+            self._group_indices = []
+            self.set_triangles(MeshCache().mesh_weights(self._obj.data, read_weights=False).triangles)
+
+    def set_weight_threshold(self, weight_threshold):
+        """Change the displayed triangles using the cached triangle weights, without scanning the mesh"""
+        if weight_threshold == self.weight_threshold:
+            return
+        self.weight_threshold = weight_threshold
+        if not self._group_indices:
+            return
+
+        self.set_triangles(MeshCache().select_triangles(self._obj.data, self._group_names,
+                                                        self._group_indices, weight_threshold))
+
+    def verify_triangles(self):
+        """Timer callback: select the triangles again if the weights have changed since they were saved"""
+        try:
+            triangles = MeshCache().verify_triangles(self._obj.data, self._group_names, self._group_indices,
+                                                     self.weight_threshold)
+        except ReferenceError:
+            # the widget object has been removed meanwhile
+            return None
+
+        if triangles is not None:
+            self.set_triangles(triangles)
+            for window in bpy.context.window_manager.windows:
+                for area in window.screen.areas:
+                    if area.type == 'VIEW_3D':
+                        area.tag_redraw()
+        return None
 
 
 class MeshShape2D(BasicShape):
-    def __init__(self, mesh, scale=1.0):
-        super().__init__(scale)
-        self.tris_from_mesh(mesh, scale=scale)
+    _projections = {}  # (mesh key, scale, matrix, view axis) -> (mesh triangles, unique vertices, triangles)
 
-    def tris_from_mesh(self, mesh, scale=100, matrix=None, view_axis=Axis.Y):
-        mesh.calc_loop_triangles()
-
-        vertices = np.empty((len(mesh.vertices), 3), 'f')
-        indices = np.empty((len(mesh.loop_triangles), 3), 'i')
-
-        mesh.vertices.foreach_get(
-            "co", np.reshape(vertices, len(mesh.vertices) * 3))
-        mesh.loop_triangles.foreach_get(
-            "vertices", np.reshape(indices, len(mesh.loop_triangles) * 3))
-
-        if matrix:
-            # we invert the matrix as we are facing the object
-            np_mat = np.array(matrix.normalized().inverted().to_3x3())
-            vertices *= matrix.to_scale()
-            np.copyto(vertices, vertices @ np_mat)
-            vertices += matrix.translation
-
-        # remove view axis
-        vertices = np.delete(vertices, view_axis.value, 1)
-        # scale
-        vertices *= scale
-
-        self.vertices = [vertices[i] for i in np.concatenate(indices)]
+    def __init__(self, mesh, scale=1.0, view_axis=Axis.Y):
+        super().__init__(scale)
+        self.tris_from_mesh(mesh, scale=scale, view_axis=view_axis)
+
+    def tris_from_mesh(self, mesh, scale=1.0, matrix=None, view_axis=Axis.Y):
+        indices = MeshCache().mesh_weights(mesh, read_weights=False).triangles
+        self.vertices = project_mesh(mesh, indices, scale=scale, matrix=matrix, view_axis=view_axis)
+
+    @classmethod
+    def projected(cls, mesh, scale=1.0, matrix=None, view_axis=Axis.Y):
+        """Return the unique vertices and the triangles of the projected mesh, as read-only arrays.
+
+        Projections are computed again only if the mesh has been changed
+        """
+        indices = MeshCache().mesh_weights(mesh, read_weights=False).triangles
+        matrix_key = tuple(map(tuple, matrix)) if matrix else None
+        key = (id_key(mesh), scale, matrix_key, view_axis)
+        try:
+            source, vertices, triangles = cls._projections[key]
+        except KeyError:
+            pass
+        else:
+            # mesh triangles are read again when the mesh changes
+            if source is indices:
+                return vertices, triangles
+
+        vertices, triangles = index_vertices(project_mesh(mesh, indices, scale=scale, matrix=matrix,
+                                                          view_axis=view_axis))
+        vertices.flags.writeable = False
+        triangles.flags.writeable = False
+        cls._projections[key] = (indices, vertices, triangles)
+        return vertices, triangles
+
+    @classmethod
+    def clear_projections(cls):
+        cls._projections.clear()
+
+
+def project_mesh(mesh, indices, scale=1.0, matrix=None, view_axis=Axis.Y):
+    """Return the triangles of the mesh flattened along view_axis, as (n, 2) float32 vertices"""
+    vertices = np.empty((len(mesh.vertices), 3), 'f')
+    mesh.vertices.foreach_get(
+        "co", np.reshape(vertices, len(mesh.vertices) * 3))
+
+    if matrix:
+        # we invert the matrix as we are facing the object
+        np_mat = np.array(matrix.normalized().inverted().to_3x3())
+        vertices *= matrix.to_scale()
+        np.copyto(vertices, vertices @ np_mat)
+        vertices += matrix.translation
+
+    # remove view axis
+    vertices = np.delete(vertices, view_axis.value, 1)
+    # scale
+    vertices *= scale
+
+    return np.ascontiguousarray(vertices[indices.ravel()], 'f')
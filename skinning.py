@@ -0,0 +1,98 @@
+import numpy as np
+
+from zlib import crc32
+
+from .mesh_cache import MeshCache
+
+
+def bone_matrices(bones, attr):
+    """Return the (n, 4, 4) matrices stored in attr of all the bones, in the order of the collection"""
+    count = len(bones)
+    matrices = np.empty(count * 16, 'f')
+    bones.foreach_get(attr, matrices)
+    # matrices are stored column by column
+    return matrices.reshape(count, 4, 4).transpose(0, 2, 1)
+
+
+class Skin:
+    """Linear blend skinning of some vertices of a mesh, deformed by the pose of an armature.
+
+    Only rest coordinates and weights of those vertices are stored, so that they can follow the pose
+    without evaluating the modifiers of the whole mesh
+    """
+    __slots__ = (
+        "rest",
+        "weights",
+        "unweighted",
+        "_pose_indices",
+        "_rest_inverse",
+        "_checksum",
+    )
+
+    def __init__(self, obj, armature, vert_indices):
+        mesh = obj.original.data
+        count = len(mesh.vertices)
+        coords = np.empty((count, 3), 'f')
+        mesh.vertices.foreach_get("co", np.reshape(coords, count * 3))
+        self.rest = coords[vert_indices]
+
+        # vertex group elements of the skinned vertices, from the sparse weight table of the mesh
+        mesh_weights = MeshCache().mesh_weights(mesh)
+        starts = mesh_weights.indptr[vert_indices]
+        lengths = mesh_weights.indptr[np.asarray(vert_indices) + 1] - starts
+        rows = np.repeat(np.arange(len(vert_indices)), lengths)
+        # position of each element in its row, added to the start of the row in the table
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        elements = np.repeat(starts, lengths) + offsets
+        groups = mesh_weights.groups[elements]
+        weights = mesh_weights.weights[elements]
+
+        # only groups named after deforming bones take part, as in the armature modifier
+        bones = armature.data.bones
+        deform_bones = {bone.name for bone in bones if bone.use_deform}
+        group_names = [vertex_group.name for vertex_group in obj.vertex_groups]
+        group_bones = np.array([name in deform_bones for name in group_names] or [False], '?')
+        in_bones = group_bones[groups] if len(groups) else np.empty(0, '?')
+
+        used_groups, columns = np.unique(groups[in_bones], return_inverse=True)
+        bone_names = [group_names[group] for group in used_groups]
+
+        self.weights = np.zeros((len(vert_indices), len(used_groups)), 'f')
+        np.add.at(self.weights, (rows[in_bones], columns.ravel()), weights[in_bones])
+
+        totals = self.weights.sum(axis=1)
+        self.unweighted = totals <= 0.0
+        totals[self.unweighted] = 1.0
+        self.weights /= totals[:, None]
+
+        bone_indices = {bone.name: i for i, bone in enumerate(bones)}
+        pose_indices = {bone.name: i for i, bone in enumerate(armature.pose.bones)}
+        rest = bone_matrices(bones, "matrix_local")[[bone_indices[name] for name in bone_names]]
+        self._rest_inverse = np.linalg.inv(rest) if len(rest) else rest
+        self._pose_indices = [pose_indices[name] for name in bone_names]
+        self._checksum = None
+
+    def deform(self, obj, armature, out):
+        """Write the world space coordinates of the skinned vertices to out, return False if the pose hasn't changed"""
+        pose = bone_matrices(armature.pose.bones, "matrix")[self._pose_indices]
+        arm_matrix = np.array(armature.matrix_world, 'f')
+        obj_matrix = np.array(obj.matrix_world, 'f')
+
+        checksum = crc32(obj_matrix, crc32(arm_matrix, crc32(np.ascontiguousarray(pose))))
+        if checksum == self._checksum:
+            return False
+        self._checksum = checksum
+
+        # world = arm_matrix @ (pose @ rest^-1) @ arm_matrix^-1 @ obj_matrix @ co
+        to_armature = np.linalg.inv(arm_matrix) @ obj_matrix
+        skin_matrices = arm_matrix @ pose @ self._rest_inverse @ to_armature
+        blended = np.einsum('nk,kab->nab', self.weights, skin_matrices[:, :3, :])
+
+        np.einsum('nab,nb->na', blended[:, :, :3], self.rest, out=out)
+        out += blended[:, :, 3]
+
+        # vertices outside of the bone groups are not deformed
+        if self.unweighted.any():
+            out[self.unweighted] = self.rest[self.unweighted] @ obj_matrix[:3, :3].T + obj_matrix[:3, 3]
+
+        return True
@@ -9,6 +9,9 @@ def panel_checkbox(self, context):
     row = self.layout.row()
     row.prop(context.window_manager, "pizmo_display_widgets")
 
+    row = self.layout.row()
+    row.prop(context.window_manager, "pizmo_triangle_budget")
+
 
 class ARMATURE_PT_pizmo_properties(bpy.types.Panel):
     bl_label = "Pizmo Armature Display"
@@ -49,6 +52,12 @@ class ARMATURE_PT_pizmo_properties(bpy.types.Panel):
         row = layout.row()
         row.prop(context.object.data, 'pizmo_widget_scale')
 
+        row = layout.row()
+        row.prop(context.object.data, 'pizmo_merged_draw')
+
+        row = layout.row()
+        row.prop(context.object.data, 'pizmo_skin_widgets')
+
         row = layout.row()
         row.operator(operators.FromExpyKit.bl_idname)
 
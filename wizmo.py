@@ -6,31 +6,46 @@ from bpy.types import (
 )
 
 from bpy_extras.view3d_utils import location_3d_to_region_2d
-from mathutils import Matrix, Vector, Quaternion
-
+from mathutils import Matrix, Vector
+import numpy as np
+
+from . import disk_cache
+from . import mesh_cache
+from . import skinning
+from . import geometry
+from . import registry
 from . import shapes
 from . import storage
 from . import enum_types
 
 from importlib import reload
+reload(disk_cache)
+reload(mesh_cache)
+reload(skinning)
+reload(geometry)
+reload(registry)
 reload(shapes)
 reload(storage)
 reload(enum_types)
 
 
-from .shapes import Circle2D, Cross2D, MeshShape3D
-from .enum_types import WidgetType, ShapeType
+from .shapes import Circle2D, Cross2D, MeshShape2D, MeshShape3D, primitive_vertices, primitive_indexed, index_vertices
+from .mesh_cache import id_key
+from .geometry import GeometryStore, MergedBatch, new_indexed_shape
+from .registry import ArmatureRegistry
+from .skinning import bone_matrices
+from .enum_types import Axis, WidgetType, ShapeType
 
 
 class BazeMo(Gizmo):
 
-    def refresh_color(self, context=None, selected=False):
+    def refresh_color(self, context=None, selected=False, obj=None):
         context = context if context else bpy.context
-        obj = context.object
+        obj = obj if obj else context.object
 
         if obj and obj.type == 'ARMATURE':
             if selected:
-                color = context.object.data.pizmo_color_selected
+                color = obj.data.pizmo_color_selected
                 alpha = min(obj.data.pizmo_color_alpha + 0.25, 1.0)
             else:
                 color = obj.data.pizmo_color_base
@@ -54,36 +69,27 @@ class ArmzMo(BazeMo):
 
     __slots__ = (
         "_custom_shape",
-        "_object_name",
+        "_object_key",
+        "_placement_revision",
     )
 
-    def refresh_shape(self):
+    @property
+    def object_key(self):
+        return self._object_key
+
+    def refresh_shape(self, placement, posed_keys=()):
         # show armature select widget for all other armatures when in pose mode, all armatures when in object mode
-        obj = self.get_object()
-        if not obj:
-            # FIXME: what if armature has been renamed
+        if not placement:
+            self.hide = True
             return
 
-        if bpy.context.mode == 'POSE':
-            self.hide = obj == bpy.context.object
-        else:
-            self.hide = not obj.visible_get()
-
-        if not self.hide:
-            if obj.data.pizmo_armature_root:
-                try:
-                    pbone = obj.pose.bones[obj.data.pizmo_armature_root]
-                except KeyError:
-                    return
+        self.hide = not placement.visible or self._object_key in posed_keys
+        if self.hide or placement.location is None:
+            return
 
-                self.matrix_space[0][3] = pbone.matrix[0][3]
-                self.matrix_space[1][3] = pbone.matrix[1][3]
-                self.matrix_space[2][3] = pbone.matrix[2][3]
-            else:
-                bound = obj.bound_box
-                self.matrix_space[0][3] = (bound[0][0] + bound[7][0]) / 2
-                self.matrix_space[1][3] = (bound[0][1] + bound[7][1]) / 2
-                self.matrix_space[2][3] = bound[0][2] # bbox min Z
+        if placement.revision != self._placement_revision:
+            self.matrix_space = Matrix.Translation(placement.location)
+            self._placement_revision = placement.revision
 
     def draw(self, context):
         self.draw_custom_shape(self.custom_shape)
@@ -92,17 +98,10 @@ class ArmzMo(BazeMo):
         self.draw_custom_shape(self.custom_shape, select_id=select_id)
 
     def get_object(self):
-        if not self._object_name:
-            return None
-        try:
-            obj = bpy.data.objects[self._object_name]
-        except KeyError:
-            return None
-
-        if obj.type != 'ARMATURE':
+        if not self._object_key:
             return None
 
-        return obj
+        return ArmatureRegistry().get_object(self._object_key)
 
     def invoke(self, context, event):
         obj = self.get_object()
@@ -129,14 +128,15 @@ class ArmzMo(BazeMo):
         self.refresh_color()
 
         if not hasattr(self, "custom_shape"):
-            self.custom_shape = self.new_custom_shape('TRIS', Circle2D().vertices)
+            self.custom_shape = GeometryStore().primitive(('circle', ()), lambda: primitive_indexed(Circle2D))
 
         self.use_draw_modal = True
         self.use_draw_scale = False
         self.use_draw_offset_scale = False
 
     def set_object(self, obj):
-        self._object_name = obj.name
+        self._object_key = id_key(obj)
+        self._placement_revision = None
 
 
 class BonezMo3D(BazeMo):
@@ -146,31 +146,53 @@ class BonezMo3D(BazeMo):
         "custom_shape",
         "bone_name",
         "bone_follow",
-        "_meshshape",
+        "object_key",
+        "widget_config",
+        "merged",
+        "lod_level",
+        "_shared",
+        "_shared_key",
         "_init_mouse_x",
         "_init_mouse_y",
-        "_init_matrix",
-        "_flip_delta"
+        "_init_matrices",
+        "_pose_indices",
+        "_flip_delta",
+        "_pending",
+        "_applied_redraw",
     )
 
+    # mesh widgets of the armature whose bone is dragged keep their geometry, the mesh is evaluated again
+    # when the drag ends. Other armatures are refreshed as usual
+    frozen_key = None
+
+    @classmethod
+    def is_frozen(cls, key):
+        return cls.frozen_key is not None and key == cls.frozen_key
+
     def draw(self, context):
+        if self.merged:
+            # drawn by the batch gizmo of its armature
+            return
         self.draw_custom_shape(self.custom_shape)
 
     def draw_select(self, context, select_id):
         self.draw_custom_shape(self.custom_shape, select_id=select_id)
 
-    def bone_is_visible(self, context):
-        bone = context.object.data.bones[self.bone_name]
-        if bone.hide:
-            return False
-
-        # layer visibility
-        layers = [i for i, layer in enumerate(bone.layers) if layer]
-        return any([context.object.data.layers[i] for i in layers])
+    @property
+    def draw_color(self):
+        if self.is_highlight:
+            return (*self.color_highlight, self.alpha_highlight)
+        return (*self.color, self.alpha)
 
     def setup(self):
-        self._meshshape = None
+        self.merged = False
+        self.lod_level = 0
+        self._shared = None
+        self._shared_key = None
         self.bone_follow = False
+        self.object_key = None
+        self.widget_config = None
+        self._pending = None
 
         self.refresh_color()
 
@@ -178,20 +200,37 @@ class BonezMo3D(BazeMo):
         self.use_draw_scale = False
         self.use_draw_offset_scale = False
 
-    def refresh_shape(self, context):
+    def refresh_shape(self, context, visible=True, matrix=None, lod_level=0):
         if self.bone_follow:
-            self.matrix_space = context.object.pose.bones[self.bone_name].matrix
+            if matrix is None:
+                matrix = self.get_object(context).pose.bones[self.bone_name].matrix
+            self.matrix_space = matrix
+
+        if not self._shared or BonezMo3D.is_frozen(self.object_key):
+            return
 
-        if not self._meshshape:
+        self.hide = not visible
+
+        if not self._shared.meshshape.triangle_count:
+            # nothing to display
+            self.hide = True
+            return
+
+        if self.hide:
             return
 
-        if context:
-            self.hide = not self.bone_is_visible(context)
+        # the shape is uploaded again only when the widget vertices have changed, in whichever viewport is first
+        self.lod_level = lod_level
+        self.custom_shape = self._shared.update(lod_level)
+
+    def set_lod_level(self, lod_level):
+        if lod_level == self.lod_level or not self._shared or self.hide:
+            return
 
-        if not self.hide:
-            self.custom_shape = self.new_custom_shape('TRIS', self._meshshape.vertices)
+        self.lod_level = lod_level
+        self.custom_shape = self._shared.update(lod_level)
 
-    def set_object(self, obj, v_grp=None, weight_threshold=0.2, widget_scale=1.1):
+    def set_object(self, obj, v_grp=None, weight_threshold=0.2, widget_scale=1.1, armature=None):
         if v_grp:
             if '{side}' in v_grp:
                 v_grps = [v_grp.replace('{side}', 'L'), v_grp.replace('{side}', 'R')]
@@ -200,41 +239,86 @@ class BonezMo3D(BazeMo):
         else:
             v_grps = []
 
-        self._meshshape = MeshShape3D(obj, scale=widget_scale, vertex_groups=v_grps, weight_threshold=weight_threshold)
-        if len(self._meshshape.vertices) > 2:
+        # the same bone widget in other viewports uses the same geometry
+        key = (self.object_key, self.bone_name, id_key(obj), tuple(v_grps), widget_scale, armature is not None)
+        self.release_shared()
+        self._shared = GeometryStore().acquire(key, lambda: MeshShape3D(obj, scale=widget_scale,
+                                                                        vertex_groups=v_grps,
+                                                                        weight_threshold=weight_threshold,
+                                                                        armature=armature))
+        self._shared_key = key
+        if self._shared.meshshape.triangle_count:
             self.refresh_shape(None)
 
+    def release_shared(self):
+        if self._shared_key is not None:
+            GeometryStore().release(self._shared_key)
+        self._shared = None
+        self._shared_key = None
+
+    def set_weight_threshold(self, weight_threshold):
+        if not self._shared:
+            return
+
+        self._shared.meshshape.set_weight_threshold(weight_threshold)
+
     def set_custom_shape(self, vertices):
-        self._meshshape = None
-        self.custom_shape = self.new_custom_shape('TRIS', vertices)
+        self.set_indexed_shape(*index_vertices(vertices))
+
+    def set_indexed_shape(self, vertices, triangles):
+        self.release_shared()
+        self.custom_shape = new_indexed_shape(vertices, triangles)
+
+    def set_primitive_shape(self, custom_shape):
+        self.release_shared()
+        self.custom_shape = custom_shape
 
     def set_bone(self, bone):
         self.bone_name = bone.name
+        self.object_key = id_key(bone.id_data)
+
+    def get_object(self, context):
+        """Return the armature of this widget among the objects in pose mode"""
+        for obj in context.objects_in_mode or ():
+            if id_key(obj) == self.object_key:
+                return obj
+
+        return None
 
     def set_position(self, x, y):
         self.matrix_offset[0][3] = x
         self.matrix_offset[1][3] = y
 
     def invoke(self, context, event):
+        obj = self.get_object(context)
+        if not obj:
+            return {'FINISHED'}
+
         if not event.shift:
             bpy.ops.pose.select_all(action='DESELECT')
 
         try:
-            bone = context.object.data.bones[self.bone_name]
+            bone = obj.data.bones[self.bone_name]
         except KeyError:
             return {'FINISHED'}
 
+        if obj != context.view_layer.objects.active:
+            # widgets of all the armatures in pose mode are displayed, the clicked one becomes active
+            context.view_layer.objects.active = obj
+
         bone.select = True
-        bones = context.object.data.bones
-        bones.active = bones[bone.name]
+        obj.data.bones.active = bone
+        self.group.set_selected(context, self.object_key, self.bone_name, extend=event.shift)
 
         self._init_mouse_x = event.mouse_x
         self._init_mouse_y = event.mouse_y
-        self._init_matrix = context.object.pose.bones[bone.name].matrix.copy()
+        # every dragged bone starts from the pose it had on click
+        self._init_matrices = bone_matrices(obj.pose.bones, "matrix")
+        self._pose_indices = {pbone.name: i for i, pbone in enumerate(obj.pose.bones)}
 
         # if we the drag point opposites the bone direction, we have to flip the mouse delta when we apply a rotation
         region_3d = context.area.spaces.active.region_3d
-        pbone = context.object.pose.bones[bone.name]
+        pbone = obj.pose.bones[bone.name]
         bone_head_screen = location_3d_to_region_2d(context.area, region_3d, pbone.head)
         bone_tail_screen = location_3d_to_region_2d(context.area, region_3d, pbone.tail)
 
@@ -244,25 +328,77 @@ class BonezMo3D(BazeMo):
         mouse_offs.normalize()
 
         self._init_flip_delta = tail_offs.dot(mouse_offs) < 0.0
+
+        self._pending = None
+        self._applied_redraw = None
+        BonezMo3D.frozen_key = self.object_key
         return {'RUNNING_MODAL'}
 
     def exit(self, context, cancel):
+        if self._pending and not cancel:
+            obj = self.get_object(context)
+            if obj:
+                self.apply_drag(context, obj)
+        self._pending = None
+
+        BonezMo3D.frozen_key = None
         self.hide = False
         context.area.header_text_set(None)
+        context.area.tag_redraw()
 
     def modal(self, context, event, tweak):
-        bone = context.object.pose.bones[self.bone_name]
-        if event.alt:
-            drag_action = bone.pizmo_alt_drag_action
-        else:
-            drag_action = bone.pizmo_drag_action
+        obj = self.get_object(context)
+        if not obj:
+            return {'FINISHED'}
+
+        bone = obj.pose.bones[self.bone_name]
+        drag_attr = "pizmo_alt_drag_action" if event.alt else "pizmo_drag_action"
+        drag_action = getattr(bone, drag_attr)
 
         if drag_action == "none":
+            BonezMo3D.frozen_key = None
             return {'FINISHED'}
 
         self.hide = True
-        delta_x = (event.mouse_x - self._init_mouse_x) / 100
-        delta_y = (event.mouse_y - self._init_mouse_y) / 100
+        self._pending = (event.mouse_x, event.mouse_y, set(tweak), drag_attr, drag_action)
+        if self._applied_redraw == GrouzMo.redraws:
+            # the viewport has not been drawn since the last transform, the latest mouse position is applied
+            # by the next redraw or mouse event
+            context.area.tag_redraw()
+            return {'RUNNING_MODAL'}
+
+        self.apply_drag(context, obj)
+        return {'RUNNING_MODAL'}
+
+    def flush_drag(self, context):
+        """Apply the pending mouse position, if any, when the viewport is about to be drawn"""
+        if not self._pending:
+            return
+
+        obj = self.get_object(context)
+        if obj:
+            self.apply_drag(context, obj)
+
+    def drag_indices(self, context, obj, drag_attr, drag_action):
+        """Return the pose bone indices of the dragged bone and of the selected bones with the same drag action"""
+        names = {self.bone_name}
+        for pbone in context.selected_pose_bones or ():
+            if pbone.id_data == obj and getattr(pbone, drag_attr) == drag_action:
+                names.add(pbone.name)
+
+        return sorted(self._pose_indices[name] for name in names if name in self._pose_indices)
+
+    def apply_drag(self, context, obj):
+        """Apply the latest pending mouse position to the dragged bones, at most once per redraw"""
+        mouse_x, mouse_y, tweak, drag_attr, drag_action = self._pending
+        self._pending = None
+        self._applied_redraw = GrouzMo.redraws
+
+        pose_bones = obj.pose.bones
+        indices = self.drag_indices(context, obj, drag_attr, drag_action)
+
+        delta_x = (mouse_x - self._init_mouse_x) / 100
+        delta_y = (mouse_y - self._init_mouse_y) / 100
         if 'SNAP' in tweak:
             delta_x = round(delta_x)
             delta_y = round(delta_y)
@@ -272,37 +408,39 @@ class BonezMo3D(BazeMo):
 
         # Screen coordinates conversion
         region_3d = context.area.spaces.active.region_3d
-        screen_delta = Vector([delta_x, delta_y, 0]) @ region_3d.view_matrix
+        view_matrix = np.array(region_3d.view_matrix, 'f')
+        screen_delta = np.array((delta_x, delta_y, 0.0), 'f') @ view_matrix[:3, :3]
 
         if drag_action == "translate":
-            screen_delta = screen_delta @ bone.matrix
-            for i, d in enumerate(screen_delta):
-                if not bone.lock_location[i]:
-                    bone.location[i] += d
+            # the delta is expressed in the space of each bone
+            matrices = bone_matrices(pose_bones, "matrix")[indices]
+            deltas = np.einsum('j,njk->nk', screen_delta, matrices[:, :3, :3])
+
+            self.add_to_vectors(pose_bones, "location", "lock_location", indices, deltas)
 
-            self._init_mouse_x = event.mouse_x
-            self._init_mouse_y = event.mouse_y
+            self._init_mouse_x = mouse_x
+            self._init_mouse_y = mouse_y
         elif drag_action == "rotate":
             if self._init_flip_delta:
                 screen_delta *= -1
             # compute new look-at
-            t_mat = self._init_matrix.to_3x3().transposed()
-            y_axis = t_mat[1]
-            z_axis = t_mat[2]
-
-            new_y_axis = y_axis + screen_delta
-            new_y_axis.normalize()
-
-            new_x_axis = new_y_axis.cross(z_axis)
-            new_x_axis.normalize()
-            new_z_axis = new_x_axis.cross(new_y_axis)
-            new_z_axis.normalize()
-
-            rot_mat = Matrix((new_x_axis, new_y_axis, new_z_axis)).transposed()
-            new_mat = Matrix.LocRotScale(self._init_matrix.translation, rot_mat,
-                                         self._init_matrix.to_scale())
-
-            bone.matrix = new_mat
+            init_matrices = self._init_matrices[indices]
+            y_axes = init_matrices[:, :3, 1]
+            z_axes = init_matrices[:, :3, 2]
+
+            new_y_axes = normalized(y_axes + screen_delta)
+            new_x_axes = normalized(np.cross(new_y_axes, z_axes))
+            new_z_axes = normalized(np.cross(new_x_axes, new_y_axes))
+
+            scales = np.linalg.norm(init_matrices[:, :3, :3], axis=1)
+            new_matrices = np.zeros_like(init_matrices)
+            new_matrices[:, :3, 0] = new_x_axes * scales[:, 0:1]
+            new_matrices[:, :3, 1] = new_y_axes * scales[:, 1:2]
+            new_matrices[:, :3, 2] = new_z_axes * scales[:, 2:3]
+            new_matrices[:, :3, 3] = init_matrices[:, :3, 3]
+            new_matrices[:, 3, 3] = 1.0
+
+            self.set_matrices(pose_bones, indices, new_matrices)
         elif drag_action == "twist":
             # TODO: twist toward visual drag
             if abs(delta_x) > abs(delta_y):
@@ -311,24 +449,177 @@ class BonezMo3D(BazeMo):
                 angle = delta_y
             angle /= 10.0
 
-            quat = bone.matrix.to_quaternion()
-            new_quat = quat @ Quaternion(Vector((0, 1, 0)), angle)
+            cos_a = np.cos(angle)
+            sin_a = np.sin(angle)
+            twist = np.array(((cos_a, 0.0, sin_a), (0.0, 1.0, 0.0), (-sin_a, 0.0, cos_a)), 'f')
+
+            # rotation of the current matrices, without scale, turned around their y axis
+            matrices = bone_matrices(pose_bones, "matrix")[indices]
+            rotations = normalized(matrices[:, :3, :3], axis=1)
 
-            new_mat = new_quat.to_matrix().to_4x4()
-            new_mat.translation = self._init_matrix.translation
-            bone.matrix = new_mat
+            new_matrices = np.zeros_like(matrices)
+            new_matrices[:, :3, :3] = rotations @ twist
+            new_matrices[:, :3, 3] = self._init_matrices[indices, :3, 3]
+            new_matrices[:, 3, 3] = 1.0
+
+            self.set_matrices(pose_bones, indices, new_matrices)
         else:
             # scale
-            diagonal = Vector((delta_x, delta_y))
-            diagonal.normalize()
-            scale = 1.0 + diagonal.dot(Vector((1.0, 0.0))) / 10
+            diagonal = normalized(np.array((delta_x, delta_y)))
+            scale = 1.0 + diagonal[0] / 10
 
-            for i in range(3):
-                if not bone.lock_scale[i]:
-                    bone.scale[i] *= scale
+            self.scale_vectors(pose_bones, "scale", "lock_scale", indices, scale)
 
-        return {'RUNNING_MODAL'}
+        # bulk writes don't go through the property updates
+        obj.update_tag()
+
+    @staticmethod
+    def add_to_vectors(pose_bones, attr, lock_attr, indices, deltas):
+        """Add deltas to a vector property of the given bones, skipping the locked channels, in one write"""
+        values, locks = BonezMo3D.read_vectors(pose_bones, attr, lock_attr)
+        values[indices] += np.where(locks[indices], 0.0, deltas)
+        pose_bones.foreach_set(attr, values.ravel())
+
+    @staticmethod
+    def scale_vectors(pose_bones, attr, lock_attr, indices, factor):
+        """Multiply a vector property of the given bones by factor, skipping the locked channels, in one write"""
+        values, locks = BonezMo3D.read_vectors(pose_bones, attr, lock_attr)
+        values[indices] *= np.where(locks[indices], 1.0, factor)
+        pose_bones.foreach_set(attr, values.ravel())
+
+    @staticmethod
+    def read_vectors(pose_bones, attr, lock_attr):
+        count = len(pose_bones)
+        values = np.empty(count * 3, 'f')
+        pose_bones.foreach_get(attr, values)
+        locks = np.empty(count * 3, '?')
+        pose_bones.foreach_get(lock_attr, locks)
+        return values.reshape(count, 3), locks.reshape(count, 3)
+
+    @staticmethod
+    def set_matrices(pose_bones, indices, matrices):
+        """Set the pose matrices of the given bones, parents first.
+
+        Each bone is converted to local space against the new pose of its parent rather than the last
+        evaluated one, so that every dragged bone ends up with the given matrix
+        """
+        targets = {pose_bones[index].name: Matrix(matrix.tolist()) for index, matrix in zip(indices, matrices)}
+        new_poses = {}
+
+        def new_pose(pbone):
+            """Return the pose matrix of pbone once the targets are set, None if it doesn't change"""
+            try:
+                return new_poses[pbone.name]
+            except KeyError:
+                pass
+
+            parent = pbone.parent
+            parent_pose = new_pose(parent) if parent else None
+            if pbone.name in targets:
+                pose = targets[pbone.name]
+            elif parent_pose is not None:
+                # moved along with a dragged ancestor
+                pose = pbone.bone.convert_local_to_pose(pbone.matrix_basis, pbone.bone.matrix_local,
+                                                        parent_matrix=parent_pose,
+                                                        parent_matrix_local=parent.bone.matrix_local)
+            else:
+                pose = None
+
+            new_poses[pbone.name] = pose
+            return pose
+
+        for pbone in sorted((pose_bones[name] for name in targets), key=lambda pb: len(pb.parent_recursive)):
+            bone = pbone.bone
+            parent = pbone.parent
+            if parent:
+                parent_pose = new_pose(parent)
+                if parent_pose is None:
+                    parent_pose = parent.matrix
+                basis = bone.convert_local_to_pose(targets[pbone.name], bone.matrix_local,
+                                                   parent_matrix=parent_pose,
+                                                   parent_matrix_local=parent.bone.matrix_local, invert=True)
+            else:
+                basis = bone.convert_local_to_pose(targets[pbone.name], bone.matrix_local, invert=True)
+            pbone.matrix_basis = basis
+
+
+def normalized(vectors, axis=-1):
+    """Return vectors scaled to unit length along axis, zero length vectors are left as they are"""
+    lengths = np.linalg.norm(vectors, axis=axis, keepdims=True)
+    return vectors / np.where(lengths > 0.0, lengths, 1.0)
+
+
+class BatchzMo(Gizmo):
+    """Draws the mesh widgets of an armature in a single call, the widgets still draw their own selection"""
+    bl_idname = "VIEW3D_GT_pizmo_batch"
+
+    __slots__ = (
+        "members",
+        "object_key",
+        "_batch",
+    )
+
+    def setup(self):
+        self.members = []
+        self.object_key = None
+        self._batch = MergedBatch()
+        self.hide_select = True
+        self.use_draw_modal = True
 
+    def draw(self, context):
+        # colors are part of the batch, highlight changes recolor it
+        if not BonezMo3D.is_frozen(self.object_key):
+            self._batch.update([(gizmo._shared, gizmo.draw_color, gizmo.lod_level)
+                                for gizmo in self.members if not gizmo.hide])
+        self._batch.draw()
+
+    def draw_select(self, context, select_id):
+        pass
+
+
+class WidgetSet:
+    """Bone widgets of an armature in pose mode, with the per-armature state needed to refresh them"""
+
+    def __init__(self, obj):
+        self.key = id_key(obj)
+        self.widgets = {}  # bone name -> gizmo
+        self.selected = set()  # names of the selected bones
+        self.bone_indices = {}  # position of the bones in the armature bone collection
+        self.pose_indices = {}  # position of the bones in the pose bone collection, which can have a different order
+        self.applied_stamp = 0  # latest edit stamp applied to these widgets
+
+    def index_bones(self, obj):
+        self.bone_indices = {bone.name: i for i, bone in enumerate(obj.data.bones)}
+        self.pose_indices = {bone.name: i for i, bone in enumerate(obj.pose.bones)}
+
+    def visible_bones(self, armature):
+        """Return the visibility of all the armature bones, in the order of armature.bones"""
+        bones = armature.bones
+        count = len(bones)
+        if count != len(self.bone_indices):
+            self.bone_indices = {bone.name: i for i, bone in enumerate(bones)}
+
+        hidden = np.empty(count, '?')
+        bones.foreach_get("hide", hidden)
+        bone_layers = np.empty(count * 32, '?')
+        bones.foreach_get("layers", bone_layers)
+        bone_layers.shape = (count, 32)
+
+        # visible if not hidden and in at least one visible layer
+        in_layers = np.any(bone_layers & np.array(armature.layers, '?'), axis=1)
+        return np.logical_and(in_layers, ~hidden).tolist()
+
+    def pose_matrices(self, obj):
+        """Return the (n, 4, 4) pose matrices of all the bones, in the order of obj.pose.bones"""
+        pose_bones = obj.pose.bones
+        count = len(pose_bones)
+        if count != len(self.pose_indices):
+            self.pose_indices = {bone.name: i for i, bone in enumerate(pose_bones)}
+
+        matrices = np.empty(count * 16, 'f')
+        pose_bones.foreach_get("matrix", matrices)
+        # matrices are stored column by column
+        return matrices.reshape(count, 4, 4).transpose(0, 2, 1)
 
 
 class GrouzMo(GizmoGroup):
@@ -340,124 +631,428 @@ class GrouzMo(GizmoGroup):
 
     draw_offset = [0.0, 0.0]
 
-    _object = None
-    _dirty = False
+    redraws = 0  # counts the redraws of the viewports, bone drags apply at most one transform per redraw
+
+    # edits are stamped rather than flagged, so that each viewport catches up with the edits it has not applied yet
+    _edit_stamp = 0
+    _rebuild_stamp = 0  # latest edit requiring all widgets to be rebuilt
+    _armature_edits = {}  # armature key -> stamp of latest edit requiring its widgets to be rebuilt
+    # edits by armature, at most one entry per bone so that a refresh only looks through the bones of its armatures
+    _bone_edits = {}  # object key -> bone name -> stamp of latest edit requiring the bone widget to be rebuilt
+    _threshold_edits = {}  # object key -> bone name -> stamp of latest change to the display group threshold
+
+    @staticmethod
+    def pose_objects(context):
+        """Return the armatures in pose mode, there can be more than one in multi-object editing"""
+        if context.mode != 'POSE':
+            return []
+
+        return [ob for ob in context.objects_in_mode or () if ob.type == 'ARMATURE']
 
     @classmethod
     def poll(cls, context):
         if not context.window_manager.pizmo_display_widgets:
             return False
 
-        ob = context.object
-        if ob and ob.type == 'ARMATURE':
-            return ob.mode == 'POSE'
+        return bool(cls.pose_objects(context))
 
-        return False
+    def widget_set(self, obj):
+        key = id_key(obj)
+        try:
+            return self._sets[key]
+        except KeyError:
+            widget_set = WidgetSet(obj)
+            self._sets[key] = widget_set
+            return widget_set
 
-    @property
-    def bone_names(self):
-        return [gizmo.bone_name for gizmo in self.gizmos if hasattr(gizmo, 'bone_name')]
-
-    def setup_from_bone_attrs(self, context):
-        for bone in context.object.pose.bones:
-            if bone.pizmo_vis_type == 'mesh' and bone.pizmo_vis_mesh:
-                mpr = self.gizmos.new(BonezMo3D.bl_idname)
-                mpr.set_object(bone.pizmo_vis_mesh, v_grp=bone.pizmo_vert_grp,
-                               weight_threshold=bone.pizmo_min_vertweight,
-                               widget_scale=context.object.data.pizmo_widget_scale)
-                mpr.set_bone(bone)
-            elif bone.pizmo_vis_type == 'shape' and bone.pizmo_vis_shape != 'none':
-                if bone.pizmo_vis_shape == 'quad':
-                    wdg_shape = shapes.Quad2D()
-                elif bone.pizmo_vis_shape == 'circle':
-                    wdg_shape = shapes.Circle2D()
-                elif bone.pizmo_vis_shape == 'sphere':
-                    wdg_shape = shapes.Sphere(scale=bone.pizmo_shape_scale, offset=bone.pizmo_shape_offset)
-                else:
-                    # TODO: report warning
-                    print("could not generate shape", bone.pizmo_vis_shape, "for", bone.name)
-                    continue
+    def setup_from_bone_attrs(self, obj):
+        widget_set = self.widget_set(obj)
+        for bone in obj.pose.bones:
+            self.setup_bone(obj, bone, widget_set)
+
+        widget_set.index_bones(obj)
+        widget_set.applied_stamp = GrouzMo._edit_stamp
+        return widget_set
+
+    @staticmethod
+    def widget_config(obj, bone):
+        """Return a hashable description of the bone widget, None if the bone has no widget"""
+        if bone.pizmo_vis_type == 'mesh' and bone.pizmo_vis_mesh:
+            return ('mesh', id_key(bone.pizmo_vis_mesh), bone.pizmo_vert_grp,
+                    obj.data.pizmo_widget_scale, obj.data.pizmo_skin_widgets)
+        if bone.pizmo_vis_type == 'shape' and bone.pizmo_vis_shape != 'none':
+            return ('shape', bone.pizmo_vis_shape, bone.pizmo_shape_frame, bone.pizmo_bone_follow,
+                    bone.pizmo_shape_scale, tuple(bone.pizmo_shape_offset))
+        return None
+
+    def setup_bone(self, obj, bone, widget_set):
+        config = self.widget_config(obj, bone)
+        if config is None:
+            self.remove_bone_gizmo(widget_set, bone.name)
+            return None
+
+        mpr = self._pool.get((widget_set.key, bone.name))
+        if mpr is not None and mpr.widget_config == config:
+            # same widget as before, shapes and cached geometry can be used as they are
+            mpr.hide = False
+            if config[0] == 'mesh':
+                mpr.set_weight_threshold(bone.pizmo_min_vertweight)
+            widget_set.widgets[bone.name] = mpr
+            return mpr
+
+        mpr = self.new_bone_gizmo(widget_set, bone.name, config)
+        if config[0] == 'mesh':
+            mpr.set_bone(bone)
+            mpr.set_object(bone.pizmo_vis_mesh, v_grp=bone.pizmo_vert_grp,
+                           weight_threshold=bone.pizmo_min_vertweight,
+                           widget_scale=obj.data.pizmo_widget_scale,
+                           armature=obj if obj.data.pizmo_skin_widgets else None)
+        else:
+            custom_shape = self.primitive_shape(bone)
+            if custom_shape is None:
+                # TODO: report warning
+                print("could not generate shape", bone.pizmo_vis_shape, "for", bone.name)
+                self.remove_bone_gizmo(widget_set, bone.name)
+                return None
+
+            mpr.set_primitive_shape(custom_shape)
+            mpr.bone_follow = bone.pizmo_bone_follow
+            mpr.set_bone(bone)
+
+        return mpr
+
+    @staticmethod
+    def primitive_shape(bone):
+        """Return the custom shape of the bone primitive, shared by all the bones with the same shape settings"""
+        shape_type = bone.pizmo_vis_shape
+        if shape_type == 'quad':
+            wdg_class = shapes.Quad2D
+            kwargs = {}
+        elif shape_type == 'circle':
+            wdg_class = shapes.Circle2D
+            kwargs = {}
+        elif shape_type == 'sphere':
+            wdg_class = shapes.Sphere
+            kwargs = {'scale': bone.pizmo_shape_scale, 'offset': tuple(bone.pizmo_shape_offset)}
+        else:
+            return None
+
+        if bone.pizmo_shape_frame:
+            kwargs['frame_thickness'] = 0.25
 
-                wdg_verts = wdg_shape.frame_vertices() if bone.pizmo_shape_frame else wdg_shape.vertices
-                mpr = self.gizmos.new(BonezMo3D.bl_idname)
-                mpr.set_custom_shape(wdg_verts)
-                mpr.bone_follow = bone.pizmo_bone_follow
-                mpr.set_bone(bone)
+        key = (shape_type, tuple(sorted(kwargs.items())))
+        return GeometryStore().primitive(key, lambda: primitive_indexed(wdg_class, **kwargs))
 
-        self._object = context.object
+    def new_bone_gizmo(self, widget_set, bone_name, config=None):
+        """Create the gizmo of a bone widget and add it to the pool, replacing any previous gizmo of that bone"""
+        self.remove_bone_gizmo(widget_set, bone_name)
+
+        mpr = self.gizmos.new(BonezMo3D.bl_idname)
+        mpr.widget_config = config
+        self._pool[(widget_set.key, bone_name)] = mpr
+        widget_set.widgets[bone_name] = mpr
+        return mpr
+
+    def remove_bone_gizmo(self, widget_set, bone_name):
+        mpr = self._pool.pop((widget_set.key, bone_name), None)
+        if mpr is None:
+            return
+
+        if widget_set.widgets.get(bone_name) == mpr:
+            del widget_set.widgets[bone_name]
+        mpr.release_shared()
+        self.gizmos.remove(mpr)
 
     def setup(self, context):
-        if context.object:
-            self.setup_from_bone_attrs(context)
+        # gizmos of every armature met so far, by (object key, bone name), parked ones are hidden
+        self._pool = {}
+        # widgets of the armatures in pose mode, by object key
+        self._sets = {}
+        # gizmos drawing the merged mesh widgets, by object key
+        self._batches = {}
+
+        for obj in self.pose_objects(context):
+            self.setup_from_bone_attrs(obj)
 
     def import_storage(self, context, clear_storage=False):
         store = storage.Storage()
         tallest = self.tallest_rigged_mesh(context)
 
+        widget_set = self.widget_set(context.object)
         for widget in store.widgets():
             mpr = None
             if widget.type == WidgetType.BONE:
                 bone_name = widget.data['bone_name']
                 if bone_name not in context.object.pose.bones:
                     continue
-                if bone_name in self.bone_names:
+                if bone_name in widget_set.widgets:
                     continue
 
                 if widget.shape == ShapeType.MESH3D:
-                    mpr = self.gizmos.new(BonezMo3D.bl_idname)
+                    mpr = self.new_bone_gizmo(widget_set, bone_name)
+                    mpr.set_bone(context.object.pose.bones[bone_name])
                     v_grp = widget.data.get('vertex_group')
                     mesh_obj = widget.data.get('object', tallest)
                     mpr.set_object(mesh_obj, v_grp=v_grp)
                 elif widget.shape == ShapeType.RECT:
-                    mpr = self.gizmos.new(BonezMo3D.bl_idname)
+                    mpr = self.new_bone_gizmo(widget_set, bone_name)
                     mpr.set_custom_shape(shapes.Rect2D.vertices)
                 elif widget.shape == ShapeType.QUAD:
-                    mpr = self.gizmos.new(BonezMo3D.bl_idname)
+                    mpr = self.new_bone_gizmo(widget_set, bone_name)
                     if widget.data.get('frame'):
-                        mpr.set_custom_shape(shapes.Quad2D().frame_vertices())
+                        mpr.set_custom_shape(primitive_vertices(shapes.Quad2D, frame_thickness=0.25))
                     else:
                         mpr.set_custom_shape(shapes.Quad2D.vertices)
                     if widget.data.get('bone_follow'):
                         mpr.bone_follow = True
                 else:
-                    mpr = self.gizmos.new(BonezMo3D.bl_idname)
+                    mpr = self.new_bone_gizmo(widget_set, bone_name)
 
                 mpr.set_bone(context.object.pose.bones[bone_name])
             if mpr:
                 if widget.shape == ShapeType.VERTICES:
                     mpr.set_custom_shape(widget.data['vertices'])
                 elif widget.shape == ShapeType.MESH:
-                    raise NotImplementedError
+                    mesh_obj = widget.data['object']
+                    mpr.set_indexed_shape(*MeshShape2D.projected(mesh_obj.data,
+                                                                 scale=widget.data.get('scale', 1.0),
+                                                                 matrix=widget.data.get('matrix'),
+                                                                 view_axis=widget.data.get('view_axis', Axis.Y)))
 
                 mpr.set_position(widget.position[0], widget.position[1])
 
         if clear_storage:
             store.clear()
 
+    def set_selected(self, context, obj_key, bone_name, extend=False):
+        """Update the selection after a click, recolor only the widgets whose selection has changed"""
+        objects = {id_key(ob): ob for ob in self.pose_objects(context)}
+
+        for key, widget_set in self._sets.items():
+            if key == obj_key:
+                changed = {bone_name} if extend else widget_set.selected ^ {bone_name}
+                if extend:
+                    widget_set.selected.add(bone_name)
+                else:
+                    widget_set.selected = {bone_name}
+            elif extend:
+                continue
+            else:
+                # clicking without shift deselects the bones of all the armatures
+                changed = widget_set.selected
+                widget_set.selected = set()
+
+            for name in changed:
+                try:
+                    gizmo = widget_set.widgets[name]
+                except KeyError:
+                    continue
+                gizmo.refresh_color(context, name in widget_set.selected, objects.get(key))
+
+    def park(self, widget_set):
+        """Hide the widgets of an armature, they will be reused if it comes back with the same widget config"""
+        for gizmo in widget_set.widgets.values():
+            gizmo.hide = True
+        widget_set.widgets.clear()
+
+        self.hide_batch(widget_set.key)
+
     def clear(self):
-        for gizmo in reversed(self.gizmos):
-            self.gizmos.remove(gizmo)
+        for widget_set in self._sets.values():
+            self.park(widget_set)
+        self._sets.clear()
 
     @staticmethod
     def mark_dirty(actor, context):
-        GrouzMo._dirty = True
+        GrouzMo._edit_stamp += 1
+        if isinstance(actor, bpy.types.PoseBone):
+            GrouzMo._bone_edits.setdefault(id_key(actor.id_data), {})[actor.name] = GrouzMo._edit_stamp
+        elif isinstance(actor, bpy.types.Armature):
+            GrouzMo._armature_edits[id_key(actor)] = GrouzMo._edit_stamp
+        else:
+            GrouzMo._rebuild_stamp = GrouzMo._edit_stamp
+
+    @staticmethod
+    def mark_threshold_dirty(actor, context):
+        GrouzMo._edit_stamp += 1
+        GrouzMo._threshold_edits.setdefault(id_key(actor.id_data), {})[actor.name] = GrouzMo._edit_stamp
+
+    @staticmethod
+    def needs_rebuild(obj, widget_set):
+        if GrouzMo._rebuild_stamp > widget_set.applied_stamp:
+            return True
+
+        return GrouzMo._armature_edits.get(id_key(obj.data), 0) > widget_set.applied_stamp
+
+    def apply_bone_edits(self, obj, widget_set):
+        """Update the widgets of the bones edited since the last refresh of this group, leave the others untouched"""
+        applied_stamp = widget_set.applied_stamp
+        if applied_stamp == GrouzMo._edit_stamp:
+            return
+
+        rebuilt = {name for name, stamp in GrouzMo._bone_edits.get(widget_set.key, {}).items()
+                   if stamp > applied_stamp}
+        thresholds = {name for name, stamp in GrouzMo._threshold_edits.get(widget_set.key, {}).items()
+                      if stamp > applied_stamp}
+
+        pose_bones = obj.pose.bones
+        for bone_name in thresholds - rebuilt:
+            try:
+                gizmo = widget_set.widgets[bone_name]
+                pbone = pose_bones[bone_name]
+            except KeyError:
+                continue
+            gizmo.set_weight_threshold(pbone.pizmo_min_vertweight)
+
+        for bone_name in rebuilt:
+            try:
+                pbone = pose_bones[bone_name]
+            except KeyError:
+                self.remove_bone_gizmo(widget_set, bone_name)
+                continue
+            self.setup_bone(obj, pbone, widget_set)
+
+        widget_set.applied_stamp = GrouzMo._edit_stamp
+
+    def draw_prepare(self, context):
+        GrouzMo.redraws += 1
+
+        # a drag deferred until this redraw is applied even if no other mouse event comes, it counts for this redraw
+        widget_set = self._sets.get(BonezMo3D.frozen_key)
+        if widget_set is not None:
+            for gizmo in widget_set.widgets.values():
+                gizmo.flush_drag(context)
+
+        # the level of detail depends on the view, which changes without a refresh
+        for gizmo, level in self.lod_levels(context).items():
+            gizmo.set_lod_level(level)
 
     def refresh(self, context):
-        if context.object != self._object:
-            GrouzMo._dirty = True
+        objects = self.pose_objects(context)
+        keys = set()
+
+        for obj in objects:
+            key = id_key(obj)
+            keys.add(key)
+
+            widget_set = self._sets.get(key)
+            if widget_set is None or not widget_set.widgets:
+                self.setup_from_bone_attrs(obj)
+            elif self.needs_rebuild(obj, widget_set):
+                self.park(widget_set)
+                self.setup_from_bone_attrs(obj)
+            else:
+                self.apply_bone_edits(obj, widget_set)
+
+        # armatures that have left pose mode
+        for key in [key for key in self._sets if key not in keys]:
+            self.park(self._sets.pop(key))
+
+        for widget_set in self._sets.values():
+            widget_set.selected.clear()
+        for bone in context.selected_pose_bones or ():
+            try:
+                self._sets[id_key(bone.id_data)].selected.add(bone.name)
+            except KeyError:
+                pass
+
+        for obj in objects:
+            self.refresh_widgets(context, obj, self._sets[id_key(obj)])
+
+    def lod_levels(self, context):
+        """Return the level of detail of the visible mesh widgets in this viewport, by gizmo, from their size on screen.
+
+        Widgets are placed from their last evaluation, hidden and empty widgets are left out
+        """
+        region = context.region
+        region_3d = context.region_data
+        if region is None or region_3d is None:
+            return {}
+
+        gizmos = [gizmo for widget_set in self._sets.values() if not BonezMo3D.is_frozen(widget_set.key)
+                  for gizmo in widget_set.widgets.values()
+                  if gizmo._shared and not gizmo.hide and gizmo._shared.meshshape.triangle_count]
+        if not gizmos:
+            return {}
+
+        meshshapes = [gizmo._shared.meshshape for gizmo in gizmos]
+        centers = np.array([meshshape.center for meshshape in meshshapes], 'f')
+        radii = np.array([meshshape.radius for meshshape in meshshapes], 'f')
+
+        # widget diameter in pixels, w is 1.0 in orthographic views
+        persp = np.array(region_3d.perspective_matrix, 'f')
+        w = np.abs(centers @ persp[3, :3] + persp[3, 3])
+        pixel_scale = region_3d.window_matrix[0][0] * region.width / 2
+        pixels = 2 * radii * pixel_scale / np.maximum(w, 1e-6)
+
+        # the coarsest level with grid cells not larger than two pixels
+        cells = np.array(shapes.LOD_CELLS[::-1])
+        max_level = len(cells)
+        levels = max_level - np.searchsorted(cells, pixels / 2)
+
+        budget = context.window_manager.pizmo_triangle_budget
+        if budget:
+            while True:
+                total = sum(len(meshshape.lod_triangles(level)) for meshshape, level in zip(meshshapes, levels))
+                if total <= budget or np.all(levels == max_level):
+                    break
+                levels = np.minimum(levels + 1, max_level)
+
+        return dict(zip(gizmos, levels.tolist()))
+
+    def refresh_widgets(self, context, obj, widget_set):
+        visible = widget_set.visible_bones(obj.data)
+        if any(gizmo.bone_follow for gizmo in widget_set.widgets.values()):
+            matrices = widget_set.pose_matrices(obj)
+        else:
+            matrices = None
 
-        if GrouzMo._dirty:
-            self.clear()
+        for bone_name, gizmo in widget_set.widgets.items():
+            try:
+                bone_visible = visible[widget_set.bone_indices[bone_name]]
+            except KeyError:
+                # bone has been renamed or removed
+                bone_visible = False
 
-        if not self.gizmos:
-            self.setup_from_bone_attrs(context)
+            matrix = None
+            if gizmo.bone_follow and matrices is not None:
+                try:
+                    matrix = Matrix(matrices[widget_set.pose_indices[bone_name]].tolist())
+                except KeyError:
+                    pass
 
-        sel_names = [bone.name for bone in context.selected_pose_bones]
-        for gizmo in self.gizmos:
-            gizmo.refresh_color(context, gizmo.bone_name in sel_names)
-            gizmo.refresh_shape(context)
+            gizmo.refresh_color(context, bone_name in widget_set.selected, obj)
+            gizmo.refresh_shape(context, visible=bone_visible, matrix=matrix, lod_level=gizmo.lod_level)
 
-        GrouzMo._dirty = False
+        self.refresh_batch(obj, widget_set)
+
+    def refresh_batch(self, obj, widget_set):
+        """Hand the mesh widgets over to the batch gizmo of the armature, or give them back their own draw call"""
+        merged = obj.data.pizmo_merged_draw
+        members = []
+        for gizmo in widget_set.widgets.values():
+            gizmo.merged = merged and gizmo._shared is not None
+            if gizmo.merged:
+                members.append(gizmo)
+
+        if not members:
+            self.hide_batch(widget_set.key)
+            return
+
+        batch_gizmo = self._batches.get(widget_set.key)
+        if batch_gizmo is None:
+            batch_gizmo = self.gizmos.new(BatchzMo.bl_idname)
+            self._batches[widget_set.key] = batch_gizmo
+
+        batch_gizmo.members = members
+        batch_gizmo.object_key = widget_set.key
+        batch_gizmo.hide = False
+
+    def hide_batch(self, key):
+        batch_gizmo = self._batches.get(key)
+        if batch_gizmo is not None:
+            batch_gizmo.members = []
+            batch_gizmo.hide = True
 
 
 class GrouzMoRoots(GizmoGroup):
@@ -468,7 +1063,6 @@ class GrouzMoRoots(GizmoGroup):
     bl_options = {'3D', 'PERSISTENT'}
 
     draw_offset = [0.0, 0.0]
-    _dirty = False
 
     @classmethod
     def poll(cls, context):
@@ -478,25 +1072,32 @@ class GrouzMoRoots(GizmoGroup):
         return context.mode in ('OBJECT', 'POSE')
 
     def setup(self, context):
-        for ob in context.scene.objects:
-            if not ob.visible_get():
-                continue
-            if ob.type != 'ARMATURE':
-                continue
-            if not ob.data.pizmo_armature_widget:
+        registry = ArmatureRegistry()
+        for key in registry.keys():
+            ob = registry.get_object(key)
+            if not ob:
                 continue
 
             mpr = self.gizmos.new(ArmzMo.bl_idname)
             mpr.set_object(ob)
 
+        self._registry_revision = ArmatureRegistry.revision
+
     def refresh(self, context):
-        if GrouzMoRoots._dirty:
+        # query the keys first, the registry bumps its revision if it needs to be rebuilt
+        ArmatureRegistry().keys()
+        if getattr(self, "_registry_revision", None) != ArmatureRegistry.revision:
             self.clear()
             self.setup(context)
-            GrouzMoRoots._dirty = False
 
+        registry = ArmatureRegistry()
+        frame = context.scene.frame_current
+        # armatures in pose mode show their bone widgets rather than their root widget
+        posed_keys = {id_key(ob) for ob in GrouzMo.pose_objects(context)}
+
+        placements = registry.placements([gizmo.object_key for gizmo in self.gizmos], frame)
         for gizmo in self.gizmos:
-            gizmo.refresh_shape()
+            gizmo.refresh_shape(placements.get(gizmo.object_key), posed_keys)
 
     def clear(self):
         for gizmo in reversed(self.gizmos):
@@ -504,4 +1105,4 @@ class GrouzMoRoots(GizmoGroup):
 
     @staticmethod
     def mark_dirty(actor, context):
-        GrouzMoRoots._dirty = True
+        ArmatureRegistry().tag()